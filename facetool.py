@@ -10,6 +10,7 @@ from facetool.util import message, force_mkdir, sample_remove, is_json_path
 from random import random
 from tqdm import tqdm
 import argparse
+import csv
 import logging
 import json
 import os
@@ -28,11 +29,14 @@ COMMANDS = (
     "distance",
     "crop",
     "encode",
+    "exportmodel",
     "extractframes",
+    "index",
     "landmarks",
     "locate",
     "pose",
     "probe",
+    "quantize",
     "sample",
     "swap",
 )
@@ -40,9 +44,13 @@ COMMANDS = (
 OUTPUT_FORMAT_CHOICES = (
     "default",
     "csv",
-    "json"
+    "json",
+    "npy"
 )
 
+# Columns of the matches of distance with multiple input faces
+MATCH_COLUMNS = ["input", "input_face", "match", "match_face", "distance"]
+
 SWAP_METHODS = [
     "faceswap",
     "faceswap3d"
@@ -79,14 +87,36 @@ def get_parser():
     parser.add_argument("--as-percentage", action = "store_true",
         help = "Show face distances as percentages"
     )
+    parser.add_argument("--batch-size", type = int,
+        default = CLASSIFY_BATCH_SIZE,
+        help = "Number of faces to classify at once"
+    )
     parser.add_argument("-bl", "--blur", type = float,
         default = BLUR_AMOUNT,
         help = "Amount of blur to use during colour correction"
     )
+    parser.add_argument("--cache-dir", type = str,
+        default = None,
+        help = "Cache face detections and landmarks in this directory, so they don't need to be calculated again on the next run"
+    )
     parser.add_argument("-dd", "--data-directory", type = str,
         default = DATA_DIRECTORY,
         help = "Directory where the data files are located"
     )
+    parser.add_argument("--detection-face-size", type = int,
+        default = DEFAULT_FACE_SIZE,
+        help = "With adaptive detection, the size (in pixels) of the smallest faces to look for. Images are scaled down so these faces are just big enough to detect"
+    )
+    parser.add_argument("--detection-strategy",
+        choices = DETECTION_STRATEGIES,
+        default = DETECTION_STRATEGIES[0],
+        help = "Detect faces on the full image ('fixed'), or on a downscaled image first and only look closer when nothing is found ('adaptive')"
+    )
+    parser.add_argument("--detector",
+        choices = DETECTOR_BACKENDS,
+        default = DETECTOR_BACKENDS[0],
+        help = "Face detector to use, 'hog' (dlib) is the most accurate, the OpenCV cascades 'haar' and 'lbp' are a lot faster but miss more faces"
+    )
     parser.add_argument("-f", "--force", action = "store_true",
         help = "Force commands and ignore warnings, like with sample"
     )
@@ -109,9 +139,20 @@ def get_parser():
         default = DEFAULT_IMAGE_WIDTH,
         help = "Width of output image / video"
     )
+    parser.add_argument("--incremental", action = "store_true",
+        help = "When encoding to an existing .npy file, only encode new and changed images"
+    )
+    parser.add_argument("-j", "--jobs", type = int,
+        default = 1,
+        help = "Number of worker processes to use for swapping, classifying, encoding and tiled detection, every worker loads its own models"
+    )
     parser.add_argument("-kt", "--keep-temp", action = "store_true",
         help = "Keep temporary files (used with video swapping)"
     )
+    parser.add_argument("--max-distance", type = float,
+        default = None,
+        help = "Only return faces with at most this distance (used with distance)"
+    )
     parser.add_argument("-m", "--model", type = str,
         help = "Use a precalculated model (for calculating distances)"
     )
@@ -135,9 +176,17 @@ def get_parser():
     parser.add_argument("--profile", action = "store_true",
         help = "Show profiler information"
     )
+    parser.add_argument("--quantization",
+        choices = QUANTIZATIONS,
+        default = "pq",
+        help = "How 'quantize' compresses encodings: 'float16' (2x smaller), 'sq8' (4x) or 'pq' (32x)"
+    )
     parser.add_argument("-q", "--quiet", action = "store_true",
         help = "Don't print output to the console"
     )
+    parser.add_argument("--resume", action = "store_true",
+        help = "Keep track of finished swaps, so an interrupted swap can be resumed by running the same command again"
+    )
     parser.add_argument("-s", "--swap", action = "store_true",
         help = "Swap input and target"
     )
@@ -147,6 +196,12 @@ def get_parser():
     parser.add_argument("--save-warped", action = "store_true",
         help = "Save warped images when averaging faces"
     )
+    parser.add_argument("--segments", type = int,
+        help = "Split videos at keyframes in this many segments that are swapped and encoded by their own worker processes (used with video swapping)"
+    )
+    parser.add_argument("--stream", action = "store_true",
+        help = "Stream video frames through ffmpeg pipes instead of temporary frame directories (used with video swapping)"
+    )
     parser.add_argument("--swap-method",
         choices = SWAP_METHODS,
         default = SWAP_METHODS[0],
@@ -161,6 +216,17 @@ def get_parser():
     parser.add_argument("-sr", "--swap-order-repeat", action = "store_true", default = False,
         help = "When using --swap-order and there are not enough target faces, repeat the sequence"
     )
+    parser.add_argument("--tile-size", type = int,
+        help = "Detect faces in very large images in overlapping tiles of this many pixels, in parallel when using --jobs (used with count, crop and locate)"
+    )
+    parser.add_argument("--top-k", type = int,
+        default = None,
+        help = "Only return this many of the closest faces (used with distance)"
+    )
+    parser.add_argument("--track", type = int,
+        default = None,
+        help = "When swapping videos, only detect faces every TRACK frames and track landmarks in between, implies --stream"
+    )
     parser.add_argument("--temp-dir", type = str,
         help = "Define the directory where temporary files should be placed"
     )
@@ -184,10 +250,14 @@ def main(args):
     config.PROFILE = args.profile
     config.QUIET = args.quiet
     config.VERBOSE = args.verbose or args.extra_verbose
+    config.DETECTION_CACHE_DIR = args.cache_dir
+    config.DETECTION_FACE_SIZE = args.detection_face_size
+    config.DETECTION_STRATEGY = args.detection_strategy
+    config.DETECTOR_BACKEND = args.detector
 
     # Check for invalid argument combinations
-    if any([args.output_format == "csv", args.output_format == "json"]) and not args.output:
-        raise ArgumentError("With CSV as output format, a filename (-o) is required")
+    if args.output_format in ("csv", "json", "npy") and not args.output:
+        raise ArgumentError(f"With {args.output_format.upper()} as output format, an output path (-o) is required")
 
     # Swap around input and target
     if args.swap:
@@ -229,40 +299,55 @@ def main(args):
 
         landmarks = Landmarks(predictor_path = args.predictor_path)
 
-        save_data = args.output_format and args.output_format != "default"
+        # The npy format streams the landmarks of all faces to a directory
+        # while we go, the other formats are written at the end
+        stream_data = args.output_format == "npy"
+        save_data = args.output_format and args.output_format not in ("default", "npy")
 
         if save_data:
             data = []
 
-        # Check if we *could* have an output directory, and if so,
-        # create it
-        if args.output and Path(args.output).could_be_dir():
-            Path(args.output).mkdir_if_not_exists()
+        if stream_data:
+            from facetool.landmarkstore import LandmarkWriter
 
-        for pathobj in Path(args.input).images():
-            path = str(pathobj)
-            logging.debug(f"Processing {path}")
+            # The writer is closed when we're interrupted as well, so all
+            # landmarks we have so far are written
+            with LandmarkWriter(args.output) as writer:
+                for pathobj in Path(args.input).images():
+                    path = str(pathobj)
+                    logging.debug(f"Getting landmarks of {path}")
 
-            logging.debug(f"Getting landmarks of {path}")
+                    boxes, marks = landmarks.get_all_landmarks(path)
+                    writer.add(path, boxes, marks)
+                    message(path, f"{len(boxes)} faces")
+        else:
+            # Check if we *could* have an output directory, and if so,
+            # create it
+            if args.output and Path(args.output).could_be_dir():
+                Path(args.output).mkdir_if_not_exists()
 
-            if not args.output:
-                outpath = None
-            else:
-                out = Path(args.output)
+            for pathobj in Path(args.input).images():
+                path = str(pathobj)
+                logging.debug(f"Processing {path}")
 
-                if out.is_dir():
-                    outpath = f"{out}/{Path(path).name}"
+                logging.debug(f"Getting landmarks of {path}")
+
+                if not args.output:
+                    outpath = None
                 else:
-                    outpath = str(out)
+                    out = Path(args.output)
 
-            marks = landmarks.get_landmarks(str(path), outpath = outpath)
+                    if out.is_dir():
+                        outpath = f"{out}/{Path(path).name}"
+                    else:
+                        outpath = str(out)
 
-            if marks and save_data:
-                points = [str(path)]
-                [points.extend([m.x, m.y]) for m in marks]
-                data.append(points)
+                marks = landmarks.get_landmarks(str(path), outpath = outpath)
 
-            message(path, marks)
+                if marks is not None and save_data:
+                    data.append([str(path)] + marks.flatten().tolist())
+
+                message(path, marks)
 
         if save_data:
             df = pd.DataFrame(data)
@@ -305,35 +390,33 @@ def main(args):
     elif args.command == "count":
         from facetool.detect import Detect
 
-        detect = Detect()
-
         if args.output_format == "csv":
-            csv = []
+            counts = []
 
-        for path in Path(args.input).images():
-            count = detect.count(path)
+        with Detect(tile_size = args.tile_size, jobs = args.jobs) as detect:
+            for path in Path(args.input).images():
+                count = detect.count(path)
 
-            message(f"Number of faces in '{path}': {count}")
+                message(f"Number of faces in '{path}': {count}")
 
-            if args.output_format == "csv":
-                csv.append({
-                    "path" : path,
-                    "count" : count
-                })
+                if args.output_format == "csv":
+                    counts.append({
+                        "path" : path,
+                        "count" : count
+                    })
 
         if args.output_format == "csv":
-            df = pd.DataFrame(csv)
+            df = pd.DataFrame(counts)
             df.to_csv(args.output)
 
     elif args.command == "locate":
         from facetool.detect import Detect
 
-        detect = Detect()
-
-        for path in Path(args.input).images():
-            to_directory = os.path.isdir(args.input)
-            locations = detect.locate(path, args.output, to_directory = to_directory)
-            message(f"Face locations in '{args.input}': {locations}")
+        with Detect(tile_size = args.tile_size, jobs = args.jobs) as detect:
+            for path in Path(args.input).images():
+                to_directory = os.path.isdir(args.input)
+                locations = detect.locate(path, args.output, to_directory = to_directory)
+                message(f"Face locations in '{args.input}': {locations}")
 
     elif args.command == "crop":
         from facetool.detect import Detect
@@ -344,8 +427,6 @@ def main(args):
         if Path(args.output).is_image():
             raise ArgumentError(f"Can't crop with an image as output")
 
-        detect = Detect()
-
         # FIXME: we need some general mechanism for juggling frames around
         TMP_DIR = "crop-tmp"
         IS_VIDEO = Path(args.input).is_video()
@@ -359,9 +440,10 @@ def main(args):
         else:
             images = Path(args.input).images()
 
-        for path in images:
-            logging.debug(f"Cropping <{path}>")
-            detect.crop(str(path), args.output)
+        with Detect(tile_size = args.tile_size, jobs = args.jobs) as detect:
+            for path in images:
+                logging.debug(f"Cropping <{path}>")
+                detect.crop(str(path), args.output)
 
         if IS_VIDEO:
             shutil.rmtree(TMP_DIR)
@@ -372,16 +454,24 @@ def main(args):
         classifier = Classifier(
             data_directory = args.data_directory,
             output_format = args.output_format,
-            predictor_path = args.predictor_path
+            predictor_path = args.predictor_path,
+            jobs = args.jobs
         )
 
-        for path in Path(args.input).images():
-            logging.debug(f"Classifying <{path}>")
-            classifier.classify(str(path))
+        paths = (str(path) for path in Path(args.input).images())
+        classifier.classify_many(paths, batch_size = args.batch_size)
 
         if args.output_format == "csv":
             classifier.to_csv(args.output)
 
+    # Freeze the classify model so it can run without TensorFlow
+    elif args.command == "exportmodel":
+        from facetool.tfmodel import export_model
+
+        out = args.output or f"{args.input}/{AGE_GENDER_GRAPH_FILENAME}"
+        export_model(args.input, out)
+        message(f"Exported the age and gender model to {out}")
+
     elif args.command == "average":
         from facetool.averager import Averager
 
@@ -419,10 +509,10 @@ def main(args):
             # Now extract all the images to said directory
             from facetool.detect import Detect
 
-            detect = Detect()
-
             logging.debug(f"Cropping <{args.input}> to {TMP_DIR}")
-            detect.crop(str(args.input), TMP_DIR)
+
+            with Detect(tile_size = args.tile_size, jobs = args.jobs) as detect:
+                detect.crop(str(args.input), TMP_DIR)
 
             # Average the stuff
             averager.average(TMP_DIR, args.output)
@@ -446,48 +536,124 @@ def main(args):
 
         logging.debug(f"Trying to recognize {args.input} in {args.target}{args.model}")
 
-        recognizer = Recognizer()
+        from facetool.encodingstore import is_npy_path
 
-        results = recognizer.recognize(
-            input_path = args.input,
-            model_path = args.model,
-            target_path = args.target,
-            as_percentage = args.as_percentage
-        )
+        recognizer = Recognizer(jobs = args.jobs)
 
-        if args.output_format == "csv":
-            pd.Series(results).to_csv(args.output, header = False)
-        elif args.output_format == "json":
-            pd.Series(results).to_json(args.output)
+        # With a directory or encodings file as input, compare all faces at
+        # once and write the matches while we go
+        if os.path.isdir(args.input) or is_json_path(args.input) or is_npy_path(args.input):
+            matches = recognizer.recognize_many(
+                input_path = args.input,
+                model_path = args.model,
+                target_path = args.target,
+                as_percentage = args.as_percentage,
+                top_k = args.top_k,
+                max_distance = args.max_distance
+            )
+
+            if args.output_format == "csv":
+                with open(args.output, "w", newline = "") as f:
+                    writer = csv.DictWriter(f, fieldnames = MATCH_COLUMNS)
+                    writer.writeheader()
+                    writer.writerows(matches)
+            elif args.output_format == "json":
+                pd.DataFrame(list(matches), columns = MATCH_COLUMNS).to_json(
+                    args.output, orient = "records"
+                )
+            else:
+                for match in matches:
+                    if match["match"] is None:
+                        message(f"{match['input']} ({match['input_face']}): no match")
+                    else:
+                        message(f"{match['input']} ({match['input_face']}) - {match['match']} ({match['match_face']}): {match['distance']}")
         else:
-            message(f"{args.input} distance to {args.target}")
-            for path, distance in results.items():
-                message(f"{path}: {distance}")
+            results = recognizer.recognize(
+                input_path = args.input,
+                model_path = args.model,
+                target_path = args.target,
+                as_percentage = args.as_percentage,
+                top_k = args.top_k,
+                max_distance = args.max_distance
+            )
+
+            if args.output_format == "csv":
+                pd.Series(results).to_csv(args.output, header = False)
+            elif args.output_format == "json":
+                pd.Series(results).to_json(args.output)
+            else:
+                message(f"{args.input} distance to {args.target}")
+                for path, distance in results.items():
+                    message(f"{path}: {distance}")
 
     elif args.command == "encode":
+        from facetool.encodingstore import is_npy_path
         from facetool.recognizer import Recognizer
 
         if not all([args.input, args.output]):
             raise ArgumentError("For encoding faces you need both input and output")
 
-        recognizer = Recognizer()
-        encodings = recognizer.encode_path(args.input)
+        recognizer = Recognizer(jobs = args.jobs)
+
+        # Large libraries are better off with a binary .npy store
+        if is_npy_path(args.output):
+            recognizer.write_encodings(args.input, args.output,
+                incremental = args.incremental
+            )
+        elif args.incremental:
+            raise ArgumentError("Incremental encoding only works with a .npy output")
+        else:
+            encodings = recognizer.encode_path(args.input)
+
+            with open(args.output, "w") as f:
+                f.write(encodings)
 
-        with open(args.output, "w") as f:
-            f.write(encodings)
+        recognizer.report_failures()
 
         message(f"Written encodings of {args.input} to {args.output}")
 
+    # Build an index of an encodings file, so distance can find the
+    # nearest faces without comparing all of them
+    elif args.command == "index":
+        from facetool.encodingstore import EncodingStore
+        from facetool.faceindex import FaceIndex, index_path
+
+        store = EncodingStore.load(args.input)
+        out = index_path(args.input)
+        FaceIndex.build(store.encodings, fingerprint = store.fingerprint).save(out)
+        message(f"Written index of {len(store)} encodings to {out}")
+
+    # Compress an encodings file, distance uses the codes to find the
+    # nearest faces, and they're small enough to keep in memory
+    elif args.command == "quantize":
+        from facetool.encodingstore import EncodingStore, is_npy_path
+        from facetool.quantize import codes_path, quantize, save_codes
+
+        if not is_npy_path(args.input):
+            raise ArgumentError("Only .npy encodings files can be quantized")
+
+        store = EncodingStore.load(args.input)
+
+        if not store.exact:
+            raise ArgumentError(f"{args.input} doesn't exist, can't quantize its codes again")
+
+        quantizer, codes = quantize(store.encodings, args.quantization)
+        out = codes_path(args.input)
+        save_codes(out, quantizer, codes, store.fingerprint)
+        message(f"Written {args.quantization} codes of {len(store)} encodings to {out} ({codes.nbytes} bytes)")
+
     elif args.command == "cluster":
         from facetool.clusterer import Clusterer
+        from facetool.encodingstore import is_npy_path
 
-        # A .json file with encodings is also valid, if that is give, use that
-        # instead
-        if is_json_path(args.input):
-            encodings = Knead(args.input).data()["encodings"]
+        # A .json or .npy file with encodings is also valid, if that is
+        # given, use that instead
+        if is_json_path(args.input) or is_npy_path(args.input):
+            from facetool.encodingstore import EncodingStore
+            encodings = EncodingStore.load(args.input)
         else:
             from facetool.recognizer import Recognizer
-            recognizer = Recognizer()
+            recognizer = Recognizer(jobs = args.jobs)
             encodings = recognizer.encode_path(args.input, return_type = "dict")
             encodings = encodings["encodings"]
 
@@ -545,7 +711,12 @@ def main(args):
             ignore_nofaces = args.ignore_nofaces,
             concurrent = not args.no_threading,
             colour_correct = not args.no_colour_correct,
-            temp_dir = args.temp_dir
+            temp_dir = args.temp_dir,
+            stream = args.stream,
+            jobs = args.jobs,
+            track = args.track,
+            resume = args.resume,
+            segments = args.segments
         )
 
         # Directory of faces to directory of heads
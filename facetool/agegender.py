@@ -0,0 +1,63 @@
+import cv2
+import logging
+import numpy as np
+import os
+from .constants import AGE_GENDER_GRAPH_FILENAME
+from .models import get_model
+
+logger = logging.getLogger(__name__)
+
+# Names of the output layers of the exported graph
+OUTPUT_NAMES = ["age_probabilities", "gender_probabilities"]
+
+"""
+Prepares a list of aligned BGR faces for the network: converts them to RGB
+and standardizes every image to zero mean and unit variance, like
+TensorFlow's per_image_standardization, but for the whole batch at once.
+"""
+def preprocess(faces):
+    images = np.asarray(faces, dtype = np.float32)[..., ::-1]
+    mean = images.mean(axis = (1, 2, 3), keepdims = True)
+    std = images.std(axis = (1, 2, 3), keepdims = True)
+    min_std = np.float32(1 / np.sqrt(images[0].size))
+    return (images - mean) / np.maximum(std, min_std)
+
+# Turns the probabilities of ages 0 - 100 into the expected age, and the
+# gender probabilities into 0 (female) or 1 (male)
+def postprocess(age_probabilities, gender_probabilities):
+    ages = age_probabilities @ np.arange(101, dtype = np.float32)
+    genders = np.argmax(gender_probabilities, axis = 1)
+    return ages, genders
+
+"""
+Runs the age and gender network exported by tfmodel.export_model with
+OpenCV's dnn module, so classifying doesn't need TensorFlow at all.
+"""
+class DnnAgeGenderModel:
+    def __init__(self, path):
+        logger.debug(f"Loading age and gender graph from {path}")
+        self.net = cv2.dnn.readNetFromTensorflow(path)
+
+    def evaluate(self, aligned_images):
+        # OpenCV wants NCHW blobs
+        blob = np.ascontiguousarray(preprocess(aligned_images).transpose(0, 3, 1, 2))
+        self.net.setInput(blob)
+        ages, genders = self.net.forward(OUTPUT_NAMES)
+        return postprocess(ages, genders)
+
+# Returns the exported graph when there is one in model_path, and otherwise
+# falls back to restoring the TensorFlow checkpoint
+def get_age_gender_model(model_path):
+    graph_path = f"{model_path}/{AGE_GENDER_GRAPH_FILENAME}"
+
+    if os.path.exists(graph_path):
+        return get_model(
+            ("age-gender", graph_path), lambda: DnnAgeGenderModel(graph_path)
+        )
+
+    logger.debug(f"No {graph_path}, using TensorFlow")
+    from .tfmodel import TfAgeGenderModel
+
+    return get_model(
+        ("age-gender", model_path), lambda: TfAgeGenderModel(model_path)
+    )
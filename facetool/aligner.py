@@ -0,0 +1,59 @@
+import cv2
+import logging
+from . import config
+from .detector import FaceDetector
+from .models import get_predictor, preload
+from imutils.face_utils import FaceAligner
+
+logger = logging.getLogger(__name__)
+
+# Size of the aligned faces the age and gender network expects
+ALIGNED_FACE_SIZE = 160
+
+"""
+Reads an image, detects all faces and returns them aligned and cropped to
+160x160 pixels, ready for classification. This doesn't need TensorFlow, so
+it can run in worker processes while the main process runs the network.
+"""
+class Aligner:
+    def __init__(self, predictor_path):
+        self.detector = FaceDetector()
+        self.aligner = FaceAligner(
+            get_predictor(predictor_path), desiredFaceWidth = ALIGNED_FACE_SIZE
+        )
+
+    def __call__(self, path):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+
+        if image is None:
+            raise IOError(f"Could not read image {path}")
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        rects = self.detector(gray, 2)
+        logging.debug(f"Aligning {len(rects)} faces of {path}")
+
+        return [self.aligner.align(image, gray, rect) for rect in rects]
+
+# Aligner of a worker process, created by _init_worker on the first job of
+# the worker
+_worker_aligner = None
+
+# Worker processes don't necessarily share the configuration of the main
+# process, so pass it along
+WORKER_CONFIG = ("DETECTION_FACE_SIZE", "DETECTION_STRATEGY", "DETECTOR_BACKEND")
+
+def _init_worker(predictor_path, settings):
+    global _worker_aligner
+
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+    preload(predictor_path)
+    _worker_aligner = Aligner(predictor_path)
+
+# Jobs carry the arguments of _init_worker, see swapper._worker_call
+def _worker_align(init_args, path):
+    if _worker_aligner is None:
+        _init_worker(*init_args)
+
+    return _worker_aligner(path)
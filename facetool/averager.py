@@ -7,6 +7,7 @@ import numpy as np
 import pdb
 from .faceaverage import similarityTransform, calculateDelaunayTriangles
 from .faceaverage import constrainPoint, warpTriangle
+from .images import read_image
 from .landmarks import Landmarks
 from .path import Path
 
@@ -27,9 +28,9 @@ class Averager:
     def _read_image(self, path):
         logging.debug(f"Reading image {path}")
 
-        img = cv2.imread(str(path))
-
-        if not isinstance(img, np.ndarray):
+        try:
+            img = read_image(path)
+        except IOError:
             return False
 
         img = np.float32(img) / 255.0
@@ -46,20 +47,18 @@ class Averager:
         allPoints = []
 
         for imgpath in Path(input_dir).images():
-            # Convert from dlib points to regular points
+            # A (68, 2) array with the landmarks of the first face
             try:
                 imgPoints = self.landmarks.get_landmarks(imgpath)
             except:
                 logging.debug("Landmark detection error")
-                imgPoints = False
+                imgPoints = None
 
             # Make sure we actually have a face
-            if not imgPoints:
+            if imgPoints is None:
                 logging.debug(f"{imgpath} does not have a face, skipping")
                 continue
 
-            imgPoints = [[p.x, p.y] for p in imgPoints]
-
             # And make sure we can actually read the file
             imageData = self._read_image(imgpath)
 
@@ -0,0 +1,268 @@
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from . import config
+from .constants import DEFAULT_FACE_SIZE, LANDMARK_CACHE_BYTES, LANDMARK_CACHE_SIZE
+import dlib
+import hashlib
+import logging
+import numpy as np
+import os
+import tempfile
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint of an image array. This hashes the underlying buffer directly,
+# so unlike hash(im.data.tobytes()) it doesn't copy the whole frame
+def fingerprint(im):
+    im = np.ascontiguousarray(im)
+    digest = hashlib.blake2b(im.data, digest_size = 16).hexdigest()
+    return f"{im.shape}-{im.dtype}-{digest}"
+
+# Digest of the contents of a file, remembered as long as the file doesn't
+# change, so we don't hash the same face image over and over again
+def file_digest(path):
+    stat = os.stat(path)
+    return _file_digest(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize = 1024)
+def _file_digest(path, size, mtime):
+    digest = hashlib.blake2b(digest_size = 20)
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def rects_to_array(rects):
+    return np.array(
+        [[r.left(), r.top(), r.right(), r.bottom()] for r in rects],
+        dtype = np.int32
+    ).reshape((-1, 4))
+
+def array_to_rects(arr):
+    rects = dlib.rectangles()
+
+    for left, top, right, bottom in arr:
+        rects.append(dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+
+    return rects
+
+def array_to_points(arr):
+    points = dlib.points()
+
+    for x, y in arr:
+        points.append(dlib.point(int(x), int(y)))
+
+    return points
+
+# Convert a list of dlib points (one for every face) to a
+# (faces, points, 2) array
+def points_to_array(shapes):
+    if len(shapes) == 0:
+        return np.zeros((0, 0, 2), dtype = np.int32)
+
+    return np.array(
+        [[[p.x, p.y] for p in points] for points in shapes],
+        dtype = np.int32
+    )
+
+# Detect all faces and their landmarks, returns a (faces, 4) array of
+# rects and a (faces, points, 2) array of landmarks
+def detect_landmarks(im, detector, predictor, upsample):
+    rects = detector(im, upsample)
+    shapes = [predictor(im, rect).parts() for rect in rects]
+
+    return rects_to_array(rects), points_to_array(shapes)
+
+_detection_cache = None
+
+# Returns the DetectionCache for config.DETECTION_CACHE_DIR, or None when
+# the cache is not enabled
+def get_detection_cache():
+    global _detection_cache
+    directory = config.DETECTION_CACHE_DIR
+
+    if not directory:
+        return None
+
+    if not _detection_cache or _detection_cache.directory != str(directory):
+        _detection_cache = DetectionCache(directory)
+
+    return _detection_cache
+
+# Key for an image file that changes when the file changes, without
+# reading the file
+def file_key(path):
+    stat = os.stat(path)
+    return f"{os.path.realpath(path)}-{stat.st_size}-{stat.st_mtime_ns}"
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray) or hasattr(value, "nbytes"):
+        return value.nbytes
+    elif isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    else:
+        return 0
+
+"""
+Least-recently-used cache, bounded by both the number of items and the size
+of the stored arrays. All operations take a lock, so one cache can be shared
+by all threads of the swapper. Worker processes each get their own copy.
+"""
+class LRUCache:
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __str__(self):
+        return f"{len(self)} items, {self.nbytes} bytes, {self.hits} hits, {self.misses} misses"
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    # Returns None when there's nothing in the cache
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits = self.hits + 1
+                return self._items[key][0]
+            else:
+                self.misses = self.misses + 1
+                return None
+
+    def set(self, key, value):
+        size = _nbytes(value)
+
+        with self._lock:
+            if key in self._items:
+                self.nbytes = self.nbytes - self._items.pop(key)[1]
+
+            self._items[key] = (value, size)
+            self.nbytes = self.nbytes + size
+
+            while self._items and (
+                len(self._items) > self.max_items or self.nbytes > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._items.popitem(last = False)
+                self.nbytes = self.nbytes - evicted_size
+
+# An LRUCache for landmarks that can be switched off with
+# config.CACHE_LANDMARKS
+class LandmarkCache(LRUCache):
+    def __init__(self, max_items = LANDMARK_CACHE_SIZE, max_bytes = LANDMARK_CACHE_BYTES):
+        super().__init__(max_items, max_bytes)
+
+    def get(self, key):
+        if not config.CACHE_LANDMARKS:
+            return None
+
+        return super().get(key)
+
+    def set(self, key, value):
+        if not config.CACHE_LANDMARKS:
+            return
+
+        super().set(key, value)
+
+"""
+Content-addressed on-disk cache for face rectangles and landmarks. Keys are
+made from the contents of the image file, the detector settings and
+(for landmarks) the contents of the predictor model, so renaming or
+touching files doesn't invalidate anything. Every entry is a small .npz
+file that is written to a temporary file first and then renamed, so
+multiple processes can safely use the same directory.
+"""
+class DetectionCache:
+    def __init__(self, directory):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok = True)
+
+    def _key(self, path, upsample, predictor_path = None, variant = None):
+        parts = [file_digest(path), f"upsample={upsample}"]
+
+        if variant:
+            parts.append(variant)
+
+        # Keep the keys of the default settings like they were, so existing
+        # cache entries stay valid
+        if config.DETECTOR_BACKEND != "hog":
+            parts.append(f"detector={config.DETECTOR_BACKEND}")
+
+        if config.DETECTION_STRATEGY != "fixed":
+            face_size = config.DETECTION_FACE_SIZE or DEFAULT_FACE_SIZE
+            parts.append(f"{config.DETECTION_STRATEGY}-{face_size}")
+
+        if predictor_path:
+            parts.append(file_digest(predictor_path))
+
+        return hashlib.blake2b("-".join(parts).encode(), digest_size = 20).hexdigest()
+
+    def _path(self, key):
+        return f"{self.directory}/{key[:2]}/{key}.npz"
+
+    def _load(self, key):
+        try:
+            with np.load(self._path(key)) as data:
+                return { k : data[k] for k in data.files }
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def _save(self, key, **arrays):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    # Returns a (faces, 4) array of rects for the image at path, calling
+    # detect() to get them when they're not in the cache yet. Use variant
+    # for detection settings that aren't in the config
+    def faces(self, path, upsample, detect, variant = None):
+        key = self._key(str(path), upsample, variant = variant)
+        data = self._load(key)
+
+        if data is not None:
+            logger.debug(f"Using cached faces for {path}")
+            return data["rects"]
+
+        rects = detect()
+        self._save(key, rects = rects)
+
+        return rects
+
+    # Returns a (rects, landmarks) tuple of arrays for the image at path,
+    # calling detect() to get them when they're not in the cache yet
+    def landmarks(self, path, upsample, predictor_path, detect):
+        key = self._key(str(path), upsample, predictor_path)
+        data = self._load(key)
+
+        if data is not None:
+            logger.debug(f"Using cached landmarks for {path}")
+            return data["rects"], data["landmarks"]
+
+        rects, landmarks = detect()
+        self._save(key, rects = rects, landmarks = landmarks)
+
+        return rects, landmarks
@@ -1,4 +1,5 @@
 from .classify import Classify
+from .constants import CLASSIFY_BATCH_SIZE
 from .util import message
 import logging
 import pandas as pd
@@ -6,32 +7,40 @@ import pandas as pd
 logger = logging.getLogger(__name__)
 
 class Classifier:
-    def __init__(self, data_directory, predictor_path, output_format):
+    def __init__(self, data_directory, predictor_path, output_format, jobs = 1):
         self.data_directory = data_directory
         self.output_format = output_format
         self.predictor_path = predictor_path
         self._classify = Classify(
             model_path = data_directory,
-            predictor_path = predictor_path
+            predictor_path = predictor_path,
+            jobs = jobs
         )
 
         if self.output_format == "csv":
             self.output = []
 
-    def classify(self, path):
-        logging.debug(f"Classifying <{path}>")
-        data = self._classify.classify(path)
-
+    def _add(self, path, data):
         if self.output_format == "csv":
             # Only one value for ages/genders for now
             self.output.append({
                 "path" : path,
-                "gender" : data["genders"][0],
-                "age" : data["ages"][0]
+                "gender" : data["genders"][0] if data["genders"] else None,
+                "age" : data["ages"][0] if data["ages"] else None
             })
 
         message(path, data)
 
+    def classify(self, path):
+        logging.debug(f"Classifying <{path}>")
+        data = self._classify.classify(path)
+        self._add(path, data)
+
+    # Classify a lot of paths in batches of batch_size faces
+    def classify_many(self, paths, batch_size = CLASSIFY_BATCH_SIZE):
+        for path, data in self._classify.classify_many(paths, batch_size):
+            self._add(path, data)
+
     def to_csv(self, path):
         logging.debug("Saving csv")
         df = pd.DataFrame(self.output)
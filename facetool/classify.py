@@ -1,17 +1,17 @@
 import logging
 logger = logging.getLogger(__name__)
 
+from .aligner import Aligner, WORKER_CONFIG, _worker_align
+from .agegender import get_age_gender_model
+from .constants import CLASSIFY_BATCH_SIZE
 from .profiler import Profiler
-from . import config, resnet
+from . import config
 profiler = Profiler("classify.py")
 
 import os
-import cv2
-import dlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import tensorflow as tf
-from imutils.face_utils import FaceAligner
-from imutils.face_utils import rect_to_bb
 
 profiler.tick("Libraries imported")
 
@@ -24,97 +24,106 @@ def get_gender(gender):
         return "unknown"
 
 class Classify:
-    def __init__(self, model_path, predictor_path, use_cuda = False):
+    def __init__(self, model_path, predictor_path, use_cuda = False, jobs = 1):
         self.model_path = model_path
         self.predictor_path = predictor_path
         self.use_cuda = use_cuda
+        self.jobs = jobs
 
         if not use_cuda:
             os.environ['CUDA_VISIBLE_DEVICES'] = ''
 
-        self._create_session()
+        self.model = get_age_gender_model(model_path)
+
+        # With multiple jobs the workers have their own aligners
+        if jobs == 1:
+            self.aligner = Aligner(predictor_path)
 
     def classify(self, path):
-        aligned_image, image, rect_nums, XY = self._load_image(path)
-        profiler.tick("Loaded image")
-        ages, genders = self._evaluate(aligned_image)
-        profiler.tick("Evaluated image")
+        _, result = next(self.classify_many([path]))
 
         if config.PROFILE:
             profiler.dump_events()
 
-        return {
-            "ages" : ages.tolist(),
-            "genders" : [get_gender(g) for g in genders.tolist()]
-        }
-
-    def _create_session(self):
-        logger.debug("Creating session")
-
-        with tf.Graph().as_default():
-            self.session = tf.Session()
-            images_pl = tf.placeholder(tf.float32, shape=[None, 160, 160, 3], name='input_image')
-            images = tf.map_fn(lambda frame: tf.reverse_v2(frame, [-1]), images_pl) #BGR TO RGB
-            images_norm = tf.map_fn(lambda frame: tf.image.per_image_standardization(frame), images)
-            train_mode = tf.placeholder(tf.bool)
-            age_logits, gender_logits, _ = resnet.inference(images_norm, keep_probability=0.8,
-                                                                         phase_train=train_mode,
-                                                                         weight_decay=1e-5)
-            gender = tf.argmax(tf.nn.softmax(gender_logits), 1)
-            age_ = tf.cast(tf.constant([i for i in range(0, 101)]), tf.float32)
-            age = tf.reduce_sum(tf.multiply(tf.nn.softmax(age_logits), age_), axis=1)
-
-            init_op = tf.group(
-                tf.global_variables_initializer(),
-                tf.local_variables_initializer()
-            )
-
-            self.session.run(init_op)
-            saver = tf.train.Saver()
-            ckpt = tf.train.get_checkpoint_state(self.model_path)
-
-            if ckpt and ckpt.model_checkpoint_path:
-                saver.restore(self.session, ckpt.model_checkpoint_path)
-                self._age = age
-                self._gender = gender
-                self._images_pl = images_pl
-                self._train_mode = train_mode
-                logger.debug("Session restorted")
-            else:
-                logger.debug("Could not create session")
-
-            profiler.tick("Created session")
-
-    def _evaluate(self, aligned_images):
-        return self.session.run(
-            [self._age, self._gender],
-
-            feed_dict = {
-                self._images_pl: aligned_images,
-                self._train_mode: False
-            }
+        return result
+
+    """
+    Classifies a lot of images at once. Aligned faces of consecutive images
+    are collected in batches of batch_size faces, so the network runs once
+    per batch instead of once per image. Yields (path, result) tuples in the
+    order of paths, where the ages and genders in result are in the order
+    of the faces in the image.
+
+    With more than one job, images are read, detected and aligned by worker
+    processes while the network runs on the previous batch.
+    """
+    def classify_many(self, paths, batch_size = CLASSIFY_BATCH_SIZE):
+        pending = deque() # (path, number of faces) that aren't yielded yet
+        faces = [] # Aligned faces that still need to be evaluated
+        ages, genders = [], [] # Results of the faces of pending paths
+
+        for path, aligned in self._align_many(paths, batch_size):
+            pending.append((path, len(aligned)))
+            faces.extend(aligned)
+
+            while len(faces) >= batch_size:
+                self._evaluate(faces[:batch_size], ages, genders)
+                del faces[:batch_size]
+
+            yield from self._finished(pending, ages, genders)
+
+        if faces:
+            self._evaluate(faces, ages, genders)
+
+        yield from self._finished(pending, ages, genders)
+
+    # Yields (path, aligned faces) tuples in the order of paths. Workers
+    # keep aligning while we're busy with a batch, but only a limited number
+    # of images is in flight, so memory stays flat
+    def _align_many(self, paths, batch_size):
+        if self.jobs == 1:
+            for path in paths:
+                yield path, self.aligner(path)
+
+            return
+
+        executor = ProcessPoolExecutor(max_workers = self.jobs)
+        init_args = (
+            self.predictor_path,
+            { key : getattr(config, key) for key in WORKER_CONFIG }
         )
+        max_pending = max(self.jobs * 2, batch_size)
+        pending = deque()
+
+        with executor:
+            for path in paths:
+                pending.append((path, executor.submit(_worker_align, init_args, path)))
+
+                if len(pending) >= max_pending:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+
+    def _evaluate(self, faces, ages, genders):
+        logger.debug(f"Evaluating a batch of {len(faces)} faces")
+        batch_ages, batch_genders = self.model.evaluate(np.array(faces))
+        ages.extend(batch_ages.tolist())
+        genders.extend(batch_genders.tolist())
+        profiler.tick("Evaluated batch")
+
+    # Yields the results of all pending paths that have all their faces
+    # evaluated
+    def _finished(self, pending, ages, genders):
+        while pending and pending[0][1] <= len(ages):
+            path, count = pending.popleft()
+
+            yield path, {
+                "ages" : ages[:count],
+                "genders" : [get_gender(g) for g in genders[:count]]
+            }
 
-    def _load_image(self, image_path):
-        detector = dlib.get_frontal_face_detector()
-        predictor = dlib.shape_predictor(self.predictor_path)
-        fa = FaceAligner(predictor, desiredFaceWidth=160)
-        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        rects = detector(gray, 2)
-        rect_nums = len(rects)
-        XY, aligned_images = [], []
-
-        if rect_nums == 0:
-            aligned_images.append(image)
-
-            return aligned_images, image, rect_nums, XY
-        else:
-            for i in range(rect_nums):
-                aligned_image = fa.align(image, gray, rects[i])
-                aligned_images.append(aligned_image)
-                (x, y, w, h) = rect_to_bb(rects[i])
-                image = cv2.rectangle(image, (x, y), (x + w, y + h), color=(255, 0, 0), thickness=2)
-                XY.append((x, y))
-
-            return np.array(aligned_images), image, rect_nums, XY
\ No newline at end of file
+            del ages[:count]
+            del genders[:count]
@@ -1,6 +1,7 @@
 # Inspired by < https://www.pyimagesearch.com/2018/07/09/face-clustering-with-python/ >
 
 from sklearn.cluster import DBSCAN
+from .encodingstore import EncodingStore
 from .path import Path
 from .util import force_mkdir
 import logging
@@ -8,18 +9,18 @@ import numpy as np
 import shutil
 
 class Clusterer:
+    # encodings is either a dict of path -> encoding or an EncodingStore
     def cluster_encodings(self, encodings):
+        if isinstance(encodings, dict):
+            encodings = EncodingStore.from_dict(encodings)
+
         logging.debug(f"Clustering {len(encodings)} encodings")
 
         clt = DBSCAN(
             metric = "euclidean"
         )
 
-        # Generate a list so we also have an index
-        faces = [ { "file" : k, "encoding" : v } for k, v in encodings.items()]
-        faces_encodings = [ i["encoding"] for i in faces ]
-
-        clt.fit(np.array(faces_encodings))
+        clt.fit(encodings.encodings)
         output = []
 
         for fid in np.unique(clt.labels_):
@@ -31,7 +32,7 @@ class Clusterer:
 
             output.append({
                 "count" : len(fid_items[0]),
-                "files" : [ faces[index]["file"] for index in fid_items[0]],
+                "files" : [ encodings.paths[index] for index in fid_items[0]],
                 "id" : int(fid)
             })
 
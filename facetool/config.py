@@ -1,4 +1,8 @@
 CACHE_LANDMARKS = True
+DETECTION_CACHE_DIR = None
+DETECTION_FACE_SIZE = None
+DETECTION_STRATEGY = "fixed"
+DETECTOR_BACKEND = "hog"
 PROFILE = False
 QUIET = False
 VERBOSE = False
\ No newline at end of file
@@ -1,14 +1,60 @@
 from pathlib import Path as OrigPath
 path = OrigPath(__file__)
 
+AGE_GENDER_GRAPH_FILENAME = "agegender.pb"
 BLUR_AMOUNT = 0.6
+# Smallest face the OpenCV cascades find
+CASCADE_FACE_SIZE = 24
+CLASSIFY_BATCH_SIZE = 64
 DATA_DIRECTORY = path.parent.parent.joinpath("data")
+DEFAULT_FACE_SIZE = 160
 DEFAULT_FRAMERATE = 30
 DEFAULT_IMAGE_WIDTH = 600
 DEFAULT_IMAGE_HEIGHT = 600
+DEFAULT_TRACK_INTERVAL = 10
 DEFAULT_TRESHOLD = 0.6
+# Rows of probes and targets per block of distances, 4096 x 4096 is 64MB
+DISTANCE_BLOCK_SIZE = 4096
+DETECTION_STRATEGIES = ("fixed", "adaptive")
+DETECTOR_BACKENDS = ("hog", "haar", "lbp")
+# Number of images a worker encodes at once
+ENCODE_BATCH_SIZE = 16
 FEATHER_AMOUNT = 11
+# Smallest face dlib's HOG detector finds without upsampling
+HOG_FACE_SIZE = 80
+IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+IMAGE_CACHE_SIZE = 8
 IMAGE_EXTENSIONS = (".jpg", ".png")
+# Number of distances (encodings times centroids) calculated at once when
+# building an index, about 64MB
+INDEX_BLOCK_SIZE = 16 * 1024 * 1024
+INDEX_ITERATIONS = 10
+# Number of nearest lists of an index that are searched for every query
+INDEX_PROBES = 8
+INDEX_TOP_K = 10
+# Number of encodings per list that k-means is trained on
+INDEX_TRAIN_SIZE = 64
+LANDMARK_CACHE_BYTES = 64 * 1024 * 1024
+LANDMARK_CACHE_SIZE = 10000
+LANDMARK_CHUNK_SIZE = 10000
+LBP_CASCADE_PATH = f"{DATA_DIRECTORY}/lbpcascade_frontalface_improved.xml"
+MIN_TRACK_OVERLAP = 0.5
 PREDICTOR_PATH = f"{DATA_DIRECTORY}/landmarks.dat"
+PREPARED_CACHE_BYTES = 256 * 1024 * 1024
+PREPARED_CACHE_SIZE = 1000
+QUANTIZATIONS = ("float16", "sq8", "pq")
+# Encodings per block when encoding or comparing compressed codes
+QUANTIZE_BLOCK_SIZE = 65536
+QUANTIZE_PQ_CENTROIDS = 256
+QUANTIZE_PQ_SUBSPACES = 16
+# Number of candidates per result that are re-ranked with their exact
+# encoding, when searching compressed codes
+QUANTIZE_RERANK = 8
 TEMP_AUDIO_FILENAME = "_audio.wav"
+# Boxes closer than this many pixels to the edge of a tile might be cut off
+TILE_EDGE_MARGIN = 8
+# Boxes from different tiles that overlap more than this are the same face
+TILE_MIN_OVERLAP = 0.5
+# Tiles overlap by this part of the tile size
+TILE_OVERLAP = 0.25
 VIDEO_EXTENSIONS = (".mp4", ".mov", ".wmv", ".m4v")
\ No newline at end of file
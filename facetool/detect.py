@@ -1,23 +1,50 @@
 # Based on https://gist.github.com/ageitgey/1c1cb1c60ace321868f7410d48c228e1
 
-import dlib
 import cv2
 import logging
 import os
 
+from .cache import array_to_rects, get_detection_cache, rects_to_array
+from .detector import FaceDetector, TiledDetector
+from .images import read_image
 from .util import get_basename, mkdir_if_not_exists
-from skimage import io
 
 logger = logging.getLogger(__name__)
 
 class Detect:
-    def __init__(self):
-        self.detector = dlib.get_frontal_face_detector()
+    def __init__(self, tile_size = None, jobs = 1):
+        self.tile_size = tile_size
+
+        if tile_size:
+            self.detector = TiledDetector(tile_size, jobs)
+        else:
+            self.detector = FaceDetector()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Stops the worker processes of a tiled detector
+    def close(self):
+        if self.tile_size:
+            self.detector.close()
+
+    def _detect(self, image):
+        return self.detector.detect_file(image)
 
     def _get_faces(self, image):
         logging.debug(f"Getting faces for {image}")
-        img = io.imread(image)
-        faces = self.detector(img)
+        cache = get_detection_cache()
+
+        if cache:
+            variant = f"tiles={self.tile_size}" if self.tile_size else None
+            faces = array_to_rects(cache.faces(
+                image, 0, lambda: rects_to_array(self._detect(image)), variant
+            ))
+        else:
+            faces = self._detect(image)
 
         if len(faces) == 0:
             logging.debug(f"No faces in {image}")
@@ -32,7 +59,7 @@ class Detect:
         logging.debug(f"Cropping {image} to {outpath}")
         mkdir_if_not_exists(outpath)
         rects = self.locate(image)
-        img = cv2.imread(image, cv2.IMREAD_COLOR)
+        img = read_image(image)
         basename = get_basename(image)
 
         for index, rect in enumerate(rects):
@@ -62,7 +89,7 @@ class Detect:
         if output:
             logging.debug(f"Writing bounding boxes to {output}")
 
-            out = cv2.imread(str(image), cv2.IMREAD_COLOR)
+            out = read_image(image).copy()
 
             for rect in rects:
                 logging.debug(f"Plotting rect: {rect}")
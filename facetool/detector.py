@@ -0,0 +1,384 @@
+import cv2
+import dlib
+import logging
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from . import config
+from .constants import (CASCADE_FACE_SIZE, DEFAULT_FACE_SIZE,
+                        DETECTION_STRATEGIES, HOG_FACE_SIZE, LBP_CASCADE_PATH,
+                        TILE_EDGE_MARGIN, TILE_MIN_OVERLAP, TILE_OVERLAP)
+from .images import read_image, reduction
+from .models import get_frontal_face_detector, preload
+
+logger = logging.getLogger(__name__)
+
+def _resize(im, scale):
+    if scale == 1:
+        return im
+
+    return cv2.resize(im, None,
+        fx = scale,
+        fy = scale,
+        interpolation = cv2.INTER_AREA
+    )
+
+def _scale_rect(rect, factor):
+    return dlib.rectangle(
+        int(round(rect.left() / factor)),
+        int(round(rect.top() / factor)),
+        int(round(rect.right() / factor)),
+        int(round(rect.bottom() / factor))
+    )
+
+"""
+dlib's HOG detector, accurate but slow on large images. This is the default
+"""
+class HogBackend:
+    face_size = HOG_FACE_SIZE
+
+    def __init__(self):
+        self.detector = get_frontal_face_detector()
+
+    def __call__(self, im, upsample = 0):
+        return self.detector(im, upsample)
+
+"""
+OpenCV cascade classifier (Haar or LBP), a lot faster than HOG but it finds
+fewer faces and more false positives. Good enough for counting and
+cropping lots of images. Rectangles are returned as dlib rectangles, so
+the shape predictor and everything else works the same as with HOG.
+"""
+class CascadeBackend:
+    face_size = CASCADE_FACE_SIZE
+
+    def __init__(self, path):
+        self.classifier = cv2.CascadeClassifier(path)
+
+        if self.classifier.empty():
+            raise IOError(f"Could not load cascade classifier from {path}")
+
+    def __call__(self, im, upsample = 0):
+        if im.ndim == 3:
+            gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = im
+
+        # Like dlib, every upsample doubles the size of the image
+        factor = 2 ** upsample
+
+        if upsample:
+            gray = cv2.resize(gray, None, fx = factor, fy = factor)
+
+        found = self.classifier.detectMultiScale(gray,
+            scaleFactor = 1.1,
+            minNeighbors = 5,
+            minSize = (self.face_size, self.face_size)
+        )
+
+        rects = dlib.rectangles()
+
+        for (x, y, w, h) in found:
+            rect = dlib.rectangle(int(x), int(y), int(x + w), int(y + h))
+            rects.append(_scale_rect(rect, factor))
+
+        return rects
+
+def get_backend(name):
+    if name == "hog":
+        return HogBackend()
+    elif name == "haar":
+        return CascadeBackend(
+            cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+        )
+    elif name == "lbp":
+        return CascadeBackend(LBP_CASCADE_PATH)
+    else:
+        raise ValueError(f"Unknown detector backend: {name}")
+
+"""
+Drop-in replacement for dlib's frontal face detector that follows the
+detector backend and detection strategy from the config. With the 'fixed'
+strategy this simply runs the detector on the full image with the given
+upsampling, like we always did.
+
+With the 'adaptive' strategy the image is first downscaled so a face of
+DETECTION_FACE_SIZE pixels is just big enough for the detector, which is a
+lot faster on high resolution photos. Only when nothing is found we try
+again at twice the size, all the way up to the full image with the given
+upsampling. Boxes are always returned in full resolution coordinates, so
+the shape predictor can run on the original image.
+"""
+class FaceDetector:
+    def __init__(self, strategy = None, face_size = None, backend = None):
+        self.detector = get_backend(backend or config.DETECTOR_BACKEND)
+        self.strategy = strategy or config.DETECTION_STRATEGY
+        self.face_size = face_size or config.DETECTION_FACE_SIZE or DEFAULT_FACE_SIZE
+
+        if self.strategy not in DETECTION_STRATEGIES:
+            raise ValueError(f"Unknown detection strategy: {self.strategy}")
+
+    def __call__(self, im, upsample = 0):
+        if self.strategy == "fixed":
+            return self.detector(im, upsample)
+
+        return self._adaptive(lambda scale: _resize(im, scale), upsample)
+
+    # Detect faces in an image file. With the adaptive strategy the first
+    # steps only need a small image, so we let the decoder reduce it
+    # Detects tiles in the worker processes and yields the boxes of every
+    # tile in order. Only a limited number of tiles is in flight at the same
+    # time, so huge images aren't copied to the workers all at once
+    def _map_tiles(self, arguments):
+        executor = self._get_executor()
+        settings = { key : getattr(config, key) for key in DETECTOR_CONFIG }
+        pending = deque()
+
+        for args in arguments:
+            pending.append(executor.submit(_worker_detect_tile, settings, *args))
+
+            if len(pending) >= self.jobs * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def detect_file(self, path, upsample = 0):
+        if self.strategy == "fixed":
+            return self.detector(read_image(path), upsample)
+
+        def scaled(scale):
+            reduce = reduction(scale)
+            return _resize(read_image(path, reduce), scale * reduce)
+
+        return self._adaptive(scaled, upsample)
+
+    # scaled(scale) returns the image at a scale of at most 1
+    def _adaptive(self, scaled, upsample):
+        for factor, times in self._steps(upsample):
+            found = self.detector(scaled(factor), times)
+
+            logging.debug(f"Detection at scale {factor}, upsample {times}: {len(found)} faces")
+
+            if len(found) > 0:
+                break
+
+        if factor >= 1:
+            return found
+
+        rects = dlib.rectangles()
+
+        for rect in found:
+            rects.append(_scale_rect(rect, factor))
+
+        return rects
+
+    # Returns a list of (scale, upsample) steps, from small to large. Below
+    # full resolution we resize the image ourselves, above it we let dlib
+    # upsample, which doubles the size every time
+    def _steps(self, upsample):
+        scale = self.detector.face_size / self.face_size
+        steps = []
+
+        while scale < 1:
+            steps.append((scale, 0))
+            scale = scale * 2
+
+        if steps:
+            first = 0
+        else:
+            first = min(upsample, math.ceil(math.log2(scale)))
+
+        steps.extend((1, times) for times in range(first, upsample + 1))
+
+        return steps
+
+# Start positions of tiles of size along a side of length, the last tile
+# ends exactly at the end
+def _tile_starts(length, size, step):
+    if length <= size:
+        return [0]
+
+    starts = list(range(0, length - size, step))
+    starts.append(length - size)
+
+    return starts
+
+# Returns (x0, y0, x1, y1) tiles of at most size x size pixels that cover an
+# image and overlap by overlap pixels
+def tiles(width, height, size, overlap):
+    step = size - overlap
+
+    return [
+        (x, y, min(x + size, width), min(y + size, height))
+        for y in _tile_starts(height, size, step)
+        for x in _tile_starts(width, size, step)
+    ]
+
+def _area(box):
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+def _intersection(a, b):
+    return _area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+
+# Intersection over union of two boxes
+def _iou(a, b):
+    inter = _intersection(a, b)
+    union = _area(a) + _area(b) - inter
+    return inter / union if union else 0
+
+# Part of box that is covered by other
+def _coverage(box, other):
+    area = _area(box)
+    return _intersection(box, other) / area if area else 0
+
+# True when a box found in tile touches one of the tile's edges that are
+# inside the image, so the face might be cut off
+def _at_inner_edge(box, tile, width, height, margin = TILE_EDGE_MARGIN):
+    x0, y0, x1, y1 = tile
+
+    return any([
+        x0 > 0 and box[0] <= x0 + margin,
+        y0 > 0 and box[1] <= y0 + margin,
+        x1 < width and box[2] >= x1 - margin,
+        y1 < height and box[3] >= y1 - margin
+    ])
+
+"""
+Non-maximum suppression for (left, top, right, bottom) boxes found in
+overlapping tiles, with intersection over union. We don't have scores for
+all detectors, so larger boxes win. A face that is cut off at the edge of a
+tile gives a smaller box inside the box of the same face in the next tile,
+with a low intersection over union. Boxes in cut (found at an inner tile
+edge) are therefore dropped when most of them is covered by a larger box,
+without dropping small faces that are really inside another box.
+"""
+def suppress(boxes, cut = (), min_overlap = TILE_MIN_OVERLAP):
+    kept = []
+    cut = set(cut)
+
+    for box in sorted(boxes, key = _area, reverse = True):
+        overlap = _coverage if box in cut else _iou
+
+        if all(overlap(box, other) < min_overlap for other in kept):
+            kept.append(box)
+
+    return kept
+
+# Detector of a tile worker process, created by _init_tile_worker on the
+# first job of the worker
+_tile_detector = None
+
+DETECTOR_CONFIG = ("DETECTION_FACE_SIZE", "DETECTION_STRATEGY", "DETECTOR_BACKEND")
+
+def _init_tile_worker(settings):
+    global _tile_detector
+
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+    preload()
+    _tile_detector = FaceDetector()
+
+def _detect_tile(detector, tile, x, y, upsample):
+    return [
+        (rect.left() + x, rect.top() + y, rect.right() + x, rect.bottom() + y)
+        for rect in detector(tile, upsample)
+    ]
+
+# Every tile carries the settings for _init_tile_worker, a worker sets up
+# its detector on its first tile
+def _worker_detect_tile(settings, *args):
+    if _tile_detector is None:
+        _init_tile_worker(settings)
+
+    return _detect_tile(_tile_detector, *args)
+
+"""
+Detects faces in very large images by cutting them in overlapping tiles,
+so the detector never sees (and upsamples) the whole image at once. With
+more than one job the tiles are divided over worker processes that all
+have their own detector. Boxes are merged with non-maximum suppression and
+returned as dlib rectangles in image coordinates, so this can be used
+everywhere a FaceDetector can. Faces larger than the overlap between tiles
+(a quarter of the tile size) might be missed or split. Use it as a context
+manager, or call close(), to stop the workers when you're done.
+"""
+class TiledDetector:
+    def __init__(self, tile_size, jobs = 1):
+        self.tile_size = tile_size
+        self.overlap = int(tile_size * TILE_OVERLAP)
+        self.jobs = jobs
+        self.detector = FaceDetector()
+        self._executor = None
+
+    def __call__(self, im, upsample = 0):
+        height, width = im.shape[:2]
+        boxes = tiles(width, height, self.tile_size, self.overlap)
+
+        if len(boxes) == 1:
+            return self.detector(im, upsample)
+
+        logging.debug(f"Detecting in {len(boxes)} tiles of {self.tile_size} pixels")
+        # Tiles are views of the image, they're only copied when they're
+        # sent to a worker
+        arguments = (
+            (im[y0:y1, x0:x1], x0, y0, upsample) for x0, y0, x1, y1 in boxes
+        )
+
+        if self.jobs > 1:
+            found = list(self._map_tiles(arguments))
+        else:
+            found = [_detect_tile(self.detector, *args) for args in arguments]
+
+        cut = [
+            box for tile, tile_boxes in zip(boxes, found) for box in tile_boxes
+            if _at_inner_edge(box, tile, width, height)
+        ]
+
+        rects = dlib.rectangles()
+
+        for box in suppress([box for tile_boxes in found for box in tile_boxes], cut):
+            rects.append(dlib.rectangle(*box))
+
+        return rects
+
+    # Detects tiles in the worker processes and yields the boxes of every
+    # tile in order. Only a limited number of tiles is in flight at the same
+    # time, so huge images aren't copied to the workers all at once
+    def _map_tiles(self, arguments):
+        executor = self._get_executor()
+        settings = { key : getattr(config, key) for key in DETECTOR_CONFIG }
+        pending = deque()
+
+        for args in arguments:
+            pending.append(executor.submit(_worker_detect_tile, settings, *args))
+
+            if len(pending) >= self.jobs * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def detect_file(self, path, upsample = 0):
+        return self(read_image(path), upsample)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Stops the worker processes, if they were started
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    # The workers are started on the first large image and then reused
+    # until close()
+    def _get_executor(self):
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(max_workers = self.jobs)
+
+        return self._executor
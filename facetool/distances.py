@@ -0,0 +1,121 @@
+import logging
+import numpy as np
+from .constants import DISTANCE_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+def _as_float32(arr):
+    return np.asarray(arr, dtype = np.float32)
+
+"""
+Yields (probe start, target start, distances) for blocks of at most
+DISTANCE_BLOCK_SIZE x DISTANCE_BLOCK_SIZE euclidean distances between the
+rows of probes and targets. Distances are calculated with one float32
+matrix product per block, so the full probes x targets matrix never exists
+and both can be memory mapped arrays of any size.
+"""
+def distance_blocks(probes, targets):
+    size = DISTANCE_BLOCK_SIZE
+
+    for probe_start in range(0, len(probes), size):
+        block_probes = _as_float32(probes[probe_start:probe_start + size])
+        probe_norms = np.einsum("ij,ij->i", block_probes, block_probes)
+
+        for target_start in range(0, len(targets), size):
+            block_targets = _as_float32(targets[target_start:target_start + size])
+            target_norms = np.einsum("ij,ij->i", block_targets, block_targets)
+
+            # |p - t|^2 = |p|^2 - 2pt + |t|^2
+            distances = block_probes @ block_targets.T
+            distances *= -2
+            distances += probe_norms[:, np.newaxis]
+            distances += target_norms[np.newaxis, :]
+            np.maximum(distances, 0, out = distances)
+            np.sqrt(distances, out = distances)
+
+            yield probe_start, target_start, distances
+
+# Set the distance of a row to itself to infinity, when comparing a set of
+# encodings to itself
+def _exclude_self(distances, probe_start, target_start):
+    probe_rows = np.arange(probe_start, probe_start + distances.shape[0])
+    columns = probe_rows - target_start
+    same = (columns >= 0) & (columns < distances.shape[1])
+    distances[np.nonzero(same)[0], columns[same]] = np.inf
+
+"""
+Yields (probe row, target rows, distances) with the k nearest targets of
+every probe, closest first, in the order of the probes. Every probe is
+returned, also when it has no targets. With max_distance only targets that
+are at least that close are returned. Set exclude_self
+when probes and targets are the same encodings.
+"""
+def nearest(probes, targets, k, max_distance = None, exclude_self = False):
+    # Without targets there are no blocks, but every probe still gets a row
+    if len(targets) == 0:
+        for probe in range(len(probes)):
+            yield probe, np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float32)
+
+        return
+
+    best_distances = best_rows = None
+    current_start = None
+
+    def finished():
+        order = np.argsort(best_distances, axis = 1)
+
+        for index in range(len(order)):
+            distances = best_distances[index, order[index]]
+            rows = best_rows[index, order[index]]
+            found = np.isfinite(distances)
+            yield current_start + index, rows[found], distances[found]
+
+    for probe_start, target_start, distances in distance_blocks(probes, targets):
+        if probe_start != current_start:
+            if current_start is not None:
+                yield from finished()
+
+            current_start = probe_start
+            best_distances = np.full((len(distances), 0), np.inf, dtype = np.float32)
+            best_rows = np.zeros((len(distances), 0), dtype = np.int64)
+
+        if exclude_self:
+            _exclude_self(distances, probe_start, target_start)
+
+        if max_distance is not None:
+            distances[distances > max_distance] = np.inf
+
+        rows = np.arange(target_start, target_start + distances.shape[1])
+        candidates = np.concatenate([best_distances, distances], axis = 1)
+        candidate_rows = np.concatenate([
+            best_rows, np.broadcast_to(rows, distances.shape)
+        ], axis = 1)
+
+        if candidates.shape[1] > k:
+            top = np.argpartition(candidates, k - 1, axis = 1)[:, :k]
+            candidates = np.take_along_axis(candidates, top, axis = 1)
+            candidate_rows = np.take_along_axis(candidate_rows, top, axis = 1)
+
+        best_distances, best_rows = candidates, candidate_rows
+
+    if current_start is not None:
+        yield from finished()
+
+"""
+Yields (probe row, target row, distance) for all pairs that are at most
+max_distance apart, without ever keeping more than one block of distances
+in memory. With exclude_self (probes and targets are the same encodings)
+every pair is only returned once.
+"""
+def pairs_within(probes, targets, max_distance, exclude_self = False):
+    for probe_start, target_start, distances in distance_blocks(probes, targets):
+        probe_rows, target_rows = np.nonzero(distances <= max_distance)
+        found = distances[probe_rows, target_rows]
+        probe_rows = probe_rows + probe_start
+        target_rows = target_rows + target_start
+
+        if exclude_self:
+            keep = probe_rows < target_rows
+            probe_rows, target_rows, found = probe_rows[keep], target_rows[keep], found[keep]
+
+        yield from zip(probe_rows.tolist(), target_rows.tolist(), found.tolist())
@@ -0,0 +1,267 @@
+import csv
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+from .cache import file_digest
+from .path import Path
+from .quantize import DecodedCodes, codes_path, load_codes
+
+logger = logging.getLogger(__name__)
+
+ENCODING_SIZE = 128
+
+def is_npy_path(path):
+    return Path(path).suffix == ".npy"
+
+# encodings.npy has its path table in encodings.paths.tsv
+def table_path(path):
+    return f"{os.path.splitext(str(path))[0]}.paths.tsv"
+
+# ... and a table of all encoded images in encodings.files.tsv
+def files_path(path):
+    return f"{os.path.splitext(str(path))[0]}.files.tsv"
+
+# Identifies the contents of a store, so an index or codes built from it
+# can tell when the store has been written again. The tables have the
+# path, face and content hash of every row, which covers images that were
+# replaced, added, removed or reordered
+def store_fingerprint(path):
+    path = str(path)
+
+    if not is_npy_path(path):
+        return file_digest(path)
+
+    tables = [table_path(path), files_path(path)]
+    return "-".join(file_digest(table) for table in tables if os.path.exists(table))
+
+def _read_table(path):
+    return pd.read_csv(path,
+        sep = "\t",
+        dtype = { "path" : str, "hash" : str },
+        keep_default_na = False
+    )
+
+"""
+Writes face encodings to a binary store, one face at a time, so memory
+doesn't grow with the number of faces. The store is a (faces, 128) float32
+.npy file that can be memory mapped, with a tab separated table next to it
+that has the path of the image and the index of the face in that image
+for every row. A second table has the size, modification time, content
+hash and number of faces of every image, also the ones without faces, so
+the store can be updated incrementally.
+
+Rows are written to a temporary file while encoding, and moved in place
+when the writer is closed, so an existing store is only replaced when
+everything has been written.
+"""
+class EncodingWriter:
+    COLUMNS = ["path", "face"]
+    FILE_COLUMNS = ["path", "size", "mtime", "hash", "faces"]
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.count = 0
+        self._rows = open(f"{self.path}.rows.tmp", "wb")
+        self._table_file = open(f"{table_path(self.path)}.tmp", "w", newline = "")
+        self._table = csv.writer(self._table_file, delimiter = "\t")
+        self._table.writerow(self.COLUMNS)
+        self._files_file = open(f"{files_path(self.path)}.tmp", "w", newline = "")
+        self._files = csv.writer(self._files_file, delimiter = "\t")
+        self._files.writerow(self.FILE_COLUMNS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    # Add the (faces, 128) encodings of an image. Pass the digest when it's
+    # already known, otherwise the file is hashed
+    def add(self, path, encodings, digest = None):
+        encodings = np.asarray(encodings, dtype = np.float32).reshape(-1, ENCODING_SIZE)
+        self._rows.write(encodings.tobytes())
+
+        for face in range(len(encodings)):
+            self._table.writerow([path, face])
+
+        stat = os.stat(path)
+        self._files.writerow([
+            path, stat.st_size, stat.st_mtime_ns, digest or file_digest(path),
+            len(encodings)
+        ])
+
+        self.count = self.count + len(encodings)
+
+    def _close_files(self):
+        self._rows.close()
+        self._table_file.close()
+        self._files_file.close()
+
+    def abort(self):
+        self._close_files()
+
+        for f in (self._rows, self._table_file, self._files_file):
+            os.remove(f.name)
+
+    def close(self):
+        self._close_files()
+
+        # Now we know the number of rows, write the .npy header and
+        # copy the rows after it
+        matrix_tmp = f"{self.path}.tmp"
+        header = {
+            "descr" : np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            "fortran_order" : False,
+            "shape" : (self.count, ENCODING_SIZE)
+        }
+
+        with open(matrix_tmp, "wb") as f, open(self._rows.name, "rb") as rows:
+            np.lib.format.write_array_header_1_0(f, header)
+
+            while True:
+                block = rows.read(1024 * 1024)
+
+                if not block:
+                    break
+
+                f.write(block)
+
+        os.remove(self._rows.name)
+        os.replace(self._files_file.name, files_path(self.path))
+        os.replace(self._table_file.name, table_path(self.path))
+        os.replace(matrix_tmp, self.path)
+        logging.debug(f"Written {self.count} encodings to {self.path}")
+
+"""
+Face encodings with their paths, either read from a binary store written
+by EncodingWriter (memory mapped, so loading is almost free) or from a
+JSON file written by 'encode' with a .json output.
+
+A binary store can also have compressed codes written by 'quantize'. These
+are loaded in memory as well, and when the .npy file itself is gone the
+encodings are decoded from the codes (exact is False then).
+"""
+class EncodingStore:
+    def __init__(self, encodings, paths, faces, files = None,
+        quantizer = None, codes = None, exact = True, fingerprint = None
+    ):
+        self.encodings = encodings
+        self.paths = paths
+        self.faces = faces
+        self.files = files or {}
+        self.quantizer = quantizer
+        self.codes = codes
+        self.exact = exact
+        self.fingerprint = fingerprint
+        self._rows = None
+
+    def __len__(self):
+        return len(self.encodings)
+
+    # Returns the (faces, 128) encodings of an image. Rows of an image are
+    # always next to each other
+    def encodings_of(self, path):
+        if self._rows is None:
+            self._rows = {}
+
+            for index, row_path in enumerate(self.paths):
+                start, stop = self._rows.get(row_path, (index, index))
+                self._rows[row_path] = (start, index + 1)
+
+        start, stop = self._rows.get(path, (0, 0))
+        return self.encodings[start:stop]
+
+    # Returns the content digest of an image when it hasn't changed since
+    # it was encoded, or None when it's new or changed. Only when the
+    # modification time is different the file is hashed
+    def unchanged_digest(self, path):
+        entry = self.files.get(path)
+
+        if not entry:
+            return None
+
+        stat = os.stat(path)
+
+        if stat.st_size != entry["size"]:
+            return None
+
+        if stat.st_mtime_ns == entry["mtime"]:
+            return entry["hash"]
+
+        digest = file_digest(path)
+        return digest if digest == entry["hash"] else None
+
+    @classmethod
+    def from_dict(cls, encodings):
+        paths = list(encodings.keys())
+        matrix = np.array(list(encodings.values()), dtype = np.float32)
+
+        return cls(
+            encodings = matrix.reshape(-1, ENCODING_SIZE),
+            paths = paths,
+            faces = np.zeros(len(paths), dtype = np.int32)
+        )
+
+    @classmethod
+    def load(cls, path):
+        path = str(path)
+
+        if not is_npy_path(path):
+            with open(path) as f:
+                store = cls.from_dict(json.load(f)["encodings"])
+
+            store.fingerprint = store_fingerprint(path)
+            return store
+
+        fingerprint = store_fingerprint(path)
+        quantizer, codes = None, None
+        exact = os.path.exists(path)
+
+        # Codes made from an earlier version of the store (images replaced,
+        # added or reordered) can't be used, not even when the number of
+        # encodings is the same
+        if os.path.exists(codes_path(path)):
+            quantizer, codes, codes_fingerprint = load_codes(codes_path(path))
+
+            if codes_fingerprint != fingerprint:
+                if not exact:
+                    raise IOError(f"{codes_path(path)} is out of date and there's no {path}")
+
+                logging.warning(f"{codes_path(path)} is out of date, run 'quantize' again")
+                quantizer, codes = None, None
+
+        if exact:
+            encodings = np.load(path, mmap_mode = "r")
+        elif codes is not None:
+            logging.debug(f"No {path}, using the codes in {codes_path(path)}")
+            encodings = DecodedCodes(quantizer, codes)
+        else:
+            raise IOError(f"No encodings or codes for {path}")
+
+        table = _read_table(table_path(path))
+
+        if len(table) != len(encodings):
+            raise IOError(f"{path} has {len(encodings)} encodings but {len(table)} paths")
+
+        # Stores written before we kept track of files can't be updated
+        # incrementally, but are fine otherwise
+        if os.path.exists(files_path(path)):
+            files = _read_table(files_path(path)).set_index("path").to_dict("index")
+        else:
+            files = None
+
+        return cls(
+            encodings = encodings,
+            paths = table["path"].tolist(),
+            faces = table["face"].to_numpy(),
+            files = files,
+            quantizer = quantizer,
+            codes = codes,
+            exact = exact,
+            fingerprint = fingerprint
+        )
@@ -0,0 +1,150 @@
+import logging
+import math
+import numpy as np
+import os
+from .constants import (INDEX_BLOCK_SIZE, INDEX_ITERATIONS, INDEX_PROBES,
+                        INDEX_TRAIN_SIZE)
+
+logger = logging.getLogger(__name__)
+
+# encodings.npy has its index in encodings.index.npz
+def index_path(path):
+    return f"{os.path.splitext(str(path))[0]}.index.npz"
+
+# Index of the nearest centroid for every vector, calculated in chunks so
+# the vectors can be a memory mapped array of any size
+def nearest_centroids(vectors, centroids):
+    # |v - c|^2 = |v|^2 - 2vc + |c|^2, and |v|^2 is the same for all c
+    centroid_norms = (centroids ** 2).sum(axis = 1)
+    labels = np.empty(len(vectors), dtype = np.int32)
+    chunk = max(1, INDEX_BLOCK_SIZE // len(centroids))
+
+    for start in range(0, len(vectors), chunk):
+        block = np.asarray(vectors[start:start + chunk], dtype = np.float32)
+        distances = centroid_norms - 2 * (block @ centroids.T)
+        labels[start:start + len(block)] = distances.argmin(axis = 1)
+
+    return labels
+
+"""
+Plain k-means on a random sample of the vectors. Clusters that end up empty
+keep their previous centroid.
+"""
+def kmeans(vectors, k, iterations = INDEX_ITERATIONS, seed = 0):
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), min(len(vectors), k * INDEX_TRAIN_SIZE), replace = False))
+    sample = np.asarray(vectors[rows], dtype = np.float32)
+    centroids = sample[rng.choice(len(sample), k, replace = False)].copy()
+
+    for iteration in range(iterations):
+        labels = nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength = k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+
+    return centroids
+
+"""
+Approximate nearest neighbour index for face encodings. The encodings are
+divided in lists around k-means centroids (an inverted file index). A
+query only looks at the lists of the nearest centroids, and re-ranks the
+encodings in those lists with their exact distance, so finding the closest
+faces in millions of encodings takes milliseconds. The index only stores
+the centroids and the rows of every list, the encodings themselves are
+read from the (memory mapped) encodings store. The fingerprint of the store
+(see encodingstore.store_fingerprint) is saved with the index, to know
+when the index is out of date.
+"""
+class FaceIndex:
+    def __init__(self, encodings, centroids, rows, offsets, fingerprint = None):
+        self.encodings = encodings
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, encodings,
+        lists = None,
+        iterations = INDEX_ITERATIONS,
+        fingerprint = None
+    ):
+        count = len(encodings)
+
+        if count == 0:
+            raise ValueError("Can't build an index without encodings")
+
+        if not lists:
+            lists = int(4 * math.sqrt(count))
+
+        lists = max(1, min(lists, count))
+        logging.debug(f"Building index of {count} encodings in {lists} lists")
+
+        centroids = kmeans(encodings, lists, iterations)
+        labels = nearest_centroids(encodings, centroids)
+        rows = np.argsort(labels, kind = "stable").astype(np.int64)
+        offsets = np.zeros(lists + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength = lists))
+
+        return cls(encodings, centroids, rows, offsets, fingerprint)
+
+    # Returns None when there's no index for this store, or when it was
+    # built for a different set of encodings. Indexes saved without a
+    # fingerprint are out of date as well
+    @classmethod
+    def load(cls, path, encodings, fingerprint = None):
+        if not os.path.exists(path):
+            return None
+
+        data = np.load(path)
+        saved = (str(data["fingerprint"]) or None) if "fingerprint" in data else None
+
+        if int(data["count"]) != len(encodings) or fingerprint != saved:
+            logging.warning(f"{path} is out of date, rebuild it with the 'index' command")
+            return None
+
+        return cls(encodings, data["centroids"], data["rows"], data["offsets"], saved)
+
+    def save(self, path):
+        # Write to a temporary file first, like the encodings store
+        tmp_path = f"{path}.tmp.npz"
+
+        np.savez(tmp_path,
+            centroids = self.centroids,
+            rows = self.rows,
+            offsets = self.offsets,
+            count = np.int64(len(self.encodings)),
+            fingerprint = self.fingerprint or ""
+        )
+
+        os.replace(tmp_path, path)
+
+    """
+    Returns the rows of the (at most) k nearest encodings to query and their
+    distances, closest first. Only the lists of the nearest probes centroids
+    are searched. Use max_distance to only get faces that are closer.
+    """
+    def search(self, query, k = None, max_distance = None, probes = INDEX_PROBES):
+        query = np.asarray(query, dtype = np.float32)
+        centroid_distances = ((self.centroids - query) ** 2).sum(axis = 1)
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(centroid_distances, probes - 1)[:probes]
+
+        # Sorted rows read the memory mapped encodings front to back
+        rows = np.sort(np.concatenate([
+            self.rows[self.offsets[l]:self.offsets[l + 1]] for l in nearest
+        ]))
+        distances = np.linalg.norm(self.encodings[rows] - query, axis = 1)
+
+        if max_distance is not None:
+            close = distances <= max_distance
+            rows, distances = rows[close], distances[close]
+
+        if k and k < len(rows):
+            top = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[top], distances[top]
+
+        order = np.argsort(distances)
+        return rows[order], distances[order]
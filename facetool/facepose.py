@@ -36,7 +36,7 @@ def detect_pose(img, shape, draw_direction_line = False, draw_points = False):
     }
 
     # Convert point to tuple
-    pose_points = {k:(p.x, p.y) for k, p in pose_points.items()}
+    pose_points = {k:(int(p[0]), int(p[1])) for k, p in pose_points.items()}
 
     image_points = np.array(list(pose_points.values()), dtype = "double")
     model_points = np.array(POINTS_3D)
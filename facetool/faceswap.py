@@ -37,15 +37,18 @@ sourceforge:
 
 """
 
-from . import config
-from .constants import FEATHER_AMOUNT, BLUR_AMOUNT
+from .cache import (LandmarkCache, LRUCache, detect_landmarks, file_key,
+                    fingerprint, get_detection_cache)
+from .constants import (FEATHER_AMOUNT, BLUR_AMOUNT, PREPARED_CACHE_BYTES,
+                        PREPARED_CACHE_SIZE)
+from .detector import FaceDetector
+from .models import get_predictor
 from .profiler import Profiler
 from .errors import TooManyFacesError, NoFacesError
 
 profiler = Profiler("faceswap.py")
 
 import cv2
-import dlib
 import numpy
 import sys
 import os
@@ -81,6 +84,28 @@ ALIGN_POINTS = (
     MOUTH_POINTS
 )
 
+"""
+An image with everything about its faces that doesn't depend on the other
+image in a swap: landmarks, alignment points, face masks and the amount of
+blur for colour correction. Prepare an image once and reuse it for all the
+swaps it's part of.
+"""
+class PreparedFace:
+    def __init__(self, im, landmarks, path = None):
+        self.im = im
+        self.landmarks = landmarks
+        self.path = path
+        self.align_points = []
+        self.blur_amounts = []
+
+        # List of (mask, offset) tuples, see Faceswap._get_face_mask
+        self.masks = []
+
+    @property
+    def nbytes(self):
+        nbytes = self.im.nbytes if self.im is not None else 0
+        return nbytes + sum(mask.nbytes for mask, offset in self.masks)
+
 class Faceswap:
     def __init__(self,
         predictor_path,
@@ -94,11 +119,12 @@ class Faceswap:
     ):
         self.predictor_path = predictor_path
         self.blur = blur
-        self.detector = dlib.get_frontal_face_detector()
+        self.detector = FaceDetector()
         self.feather = feather
-        self.predictor = dlib.shape_predictor(self.predictor_path)
+        self.predictor = get_predictor(self.predictor_path)
         self.overlay_points = []
-        self.landmark_hashes = {}
+        self.landmark_cache = LandmarkCache()
+        self.prepared_cache = LRUCache(PREPARED_CACHE_SIZE, PREPARED_CACHE_BYTES)
         self.ignore_nofaces = ignore_nofaces
         self.colour_correct = colour_correct
 
@@ -116,6 +142,8 @@ class Faceswap:
             if overlay_nosemouth:
                 self.overlay_points.append(NOSE_MOUTH_POINTS)
 
+        self.overlay_indexes = sorted(set(sum(self.overlay_points, [])))
+
     def _annotate_landmarks(self, im, landmarks):
         im = im.copy()
         for idx, point in enumerate(landmarks):
@@ -127,87 +155,138 @@ class Faceswap:
             cv2.circle(im, pos, 3, color=(0, 255, 255))
         return im
 
-    def _correct_colours(self, im1, im2, landmarks1):
+    def _blur_amount(self, landmarks1):
+        blur_amount = self.blur * numpy.linalg.norm(
+                                  numpy.mean(landmarks1[LEFT_EYE_POINTS], axis=0) -
+                                  numpy.mean(landmarks1[RIGHT_EYE_POINTS], axis=0))
+        blur_amount = int(blur_amount)
+        if blur_amount % 2 == 0:
+            blur_amount += 1
+        return blur_amount
+
+    # Bounding box (x0, y0, x1, y1) of points, grown by pad pixels and
+    # clipped to an image of the given shape
+    def _bounds(self, points, pad, shape):
+        points = numpy.asarray(points)
+        x0, y0 = numpy.floor(points.min(axis=0)).astype(int) - pad
+        x1, y1 = numpy.ceil(points.max(axis=0)).astype(int) + pad + 1
+
+        return max(x0, 0), max(y0, 0), min(x1, shape[1]), min(y1, shape[0])
+
+    # im1 and im2 are the same region of the head and the warped face, inner
+    # is the part of that region we need the result for. The region should
+    # be large enough for the blur, so the result is the same as when
+    # blurring the whole image
+    def _correct_colours(self, im1, im2, blur_amount, inner):
         if self.colour_correct:
-            blur_amount = self.blur * numpy.linalg.norm(
-                                      numpy.mean(landmarks1[LEFT_EYE_POINTS], axis=0) -
-                                      numpy.mean(landmarks1[RIGHT_EYE_POINTS], axis=0))
-            blur_amount = int(blur_amount)
-            if blur_amount % 2 == 0:
-                blur_amount += 1
-            im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)
-            im2_blur = cv2.GaussianBlur(im2, (blur_amount, blur_amount), 0)
+            im1_blur = cv2.GaussianBlur(im1, (blur_amount, blur_amount), 0)[inner]
+            im2_blur = cv2.GaussianBlur(im2, (blur_amount, blur_amount), 0)[inner]
 
             # Avoid divide-by-zero errors.
             im2_blur += (128 * (im2_blur <= 1.0)).astype(im2_blur.dtype)
 
-            return (im2.astype(numpy.float64) * im1_blur.astype(numpy.float64) /
-                                                    im2_blur.astype(numpy.float64))
+            return (im2[inner].astype(numpy.float32) * im1_blur.astype(numpy.float32) /
+                                                         im2_blur.astype(numpy.float32))
         else:
-            return im2
+            return im2[inner].astype(numpy.float32)
 
     def _draw_convex_hull(self, im, points, color):
         points = cv2.convexHull(points)
         cv2.fillConvexPoly(im, points, color=color)
 
-    def _get_face_mask(self, im, landmarks):
-        im = numpy.zeros(im.shape[:2], dtype=numpy.float64)
+    # Crop a mask at offset to the region x0, y0, x1, y1 of the image, parts
+    # of the region outside of the mask are zero
+    def _crop_mask(self, mask, offset, region):
+        x0, y0, x1, y1 = region
+        ox, oy = offset
+        out = numpy.zeros((y1 - y0, x1 - x0), dtype=mask.dtype)
+        ix0, iy0 = max(x0, ox), max(y0, oy)
+        ix1, iy1 = min(x1, ox + mask.shape[1]), min(y1, oy + mask.shape[0])
+
+        if ix0 < ix1 and iy0 < iy1:
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = \
+                mask[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+
+        return out
+
+    # Single channel mask of the face, only on the region of the image it
+    # covers. Returns the mask and the offset of that region in the image
+    def _get_face_mask(self, landmarks, shape):
+        points = numpy.asarray(landmarks)
+
+        # Blurring twice with the feather kernel grows the mask, leave room
+        # for one more blur so the edges are the same as when blurring the
+        # whole image
+        pad = 3 * (self.feather // 2) + 1
+        x0, y0, x1, y1 = self._bounds(points[self.overlay_indexes], pad, shape)
+        im = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.float32)
+        points = (points - (x0, y0)).astype(numpy.int32)
 
         for group in self.overlay_points:
             self._draw_convex_hull(im,
-                             landmarks[group],
+                             points[group],
                              color=1)
 
-        im = numpy.array([im, im, im]).transpose((1, 2, 0))
-
-        im = (cv2.GaussianBlur(im, (self.feather, self.feather), 0) > 0) * 1.0
+        im = (cv2.GaussianBlur(im, (self.feather, self.feather), 0) > 0).astype(numpy.float32)
         im = cv2.GaussianBlur(im, (self.feather, self.feather), 0)
 
-        return im
+        return im, (x0, y0)
 
     def _get_landmarks(self, im):
         # This is by far the slowest part of the whole algorithm, so we
         # cache the landmarks if the image is the same, especially when
         # dealing with videos this makes things twice as fast
-        img_hash = str(abs(hash(im.data.tobytes())))
+        img_hash = fingerprint(im)
+        landmarks = self.landmark_cache.get(img_hash)
 
-        if config.CACHE_LANDMARKS and img_hash in self.landmark_hashes:
+        if landmarks is not None:
             logging.debug("Landmarks are cached, return those")
-            return self.landmark_hashes[img_hash]
+            return landmarks
 
-        rects = self.detector(im, 1)
+        rects, landmarks = detect_landmarks(im, self.detector, self.predictor, 1)
 
         if len(rects) == 0:
             raise NoFacesError
 
-        landmarks = []
-
-        for rect in rects:
-            landmarks.append(
-                numpy.matrix([[p.x, p.y] for p in self.predictor(im, rect).parts()])
-            )
+        landmarks = [numpy.matrix(l) for l in landmarks]
 
         # Save to image cache
-        self.landmark_hashes[img_hash] = landmarks
+        self.landmark_cache.set(img_hash, landmarks)
 
         return landmarks
 
-    def _read_im_and_landmarks(self, fname):
-        logger.debug(f"Reading {fname} for landmarks")
-        profiler.tick("start _read_im_and_landmarks (imread)")
+    def _read_im(self, fname):
+        logger.debug(f"Reading {fname}")
+        profiler.tick("start _read_im (imread)")
         im = cv2.imread(fname, cv2.IMREAD_COLOR)
-        profiler.tick("end _read_im_and_landmarks (imread)")
+        profiler.tick("end _read_im (imread)")
+
+        return im
 
-        im = cv2.resize(im, (im.shape[1] * SCALE_FACTOR,
-                             im.shape[0] * SCALE_FACTOR))
+    # Landmarks can also be given (e.g. by a tracker), as a list with a
+    # (68, 2) array for every face
+    def _im_and_landmarks(self, im, landmarks = None):
+        if SCALE_FACTOR != 1:
+            im = cv2.resize(im, (im.shape[1] * SCALE_FACTOR,
+                                 im.shape[0] * SCALE_FACTOR))
 
-        profiler.tick("_read_im_and_landmarks (resize)")
+            profiler.tick("_im_and_landmarks (resize)")
+
+        if landmarks is not None:
+            if len(landmarks) == 0:
+                raise NoFacesError
+
+            return im, [numpy.matrix(l) * SCALE_FACTOR for l in landmarks]
 
         s = self._get_landmarks(im)
-        profiler.tick("_read_im_and_landmarks (_get_landmarks)")
+        profiler.tick("_im_and_landmarks (_get_landmarks)")
 
         return im, s
 
+    def _read_im_and_landmarks(self, fname):
+        logger.debug(f"Reading {fname} for landmarks")
+        return self._im_and_landmarks(self._read_im(fname))
+
     def _transformation_from_points(self, points1, points2):
         """
         Return an affine transformation [s * R | T] such that:
@@ -257,20 +336,92 @@ class Faceswap:
                        flags=cv2.WARP_INVERSE_MAP)
         return output_im
 
+    # Landmarks of an image file from the on-disk detection cache, or None
+    # if that isn't enabled
+    def _cached_landmarks(self, fname, im):
+        cache = get_detection_cache()
+
+        if not cache:
+            return None
+
+        rects, landmarks = cache.landmarks(fname, 1, self.predictor_path,
+            lambda: detect_landmarks(im, self.detector, self.predictor, 1)
+        )
+
+        return landmarks
+
     def faceswap(self, head, face, output, order = None, order_repeat = False):
         logger.debug(f"Faceswap {head} on {face} as {output}")
-        logger.debug(f"Order: {order}")
 
+        output_im = self.swap_prepared(
+            self.prepare_path(head),
+            self.prepare_path(face),
+            order = order,
+            order_repeat = order_repeat
+        )
+
+        cv2.imwrite(output, output_im)
+
+    def prepare(self, im, landmarks = None, path = None):
         try:
-            im1, landmarks1 = self._read_im_and_landmarks(head)
-            im2, landmarks2 = self._read_im_and_landmarks(face)
+            im, landmarks = self._im_and_landmarks(im, landmarks)
         except:
+            landmarks = []
+
+        face = PreparedFace(im, landmarks, path)
+
+        for points in landmarks:
+            face.align_points.append(points[ALIGN_POINTS])
+            face.blur_amounts.append(self._blur_amount(points))
+            face.masks.append(self._get_face_mask(points, im.shape))
+
+        return face
+
+    # Prepare an image file, images that were prepared before (and haven't
+    # changed since) are returned from the cache
+    def prepare_path(self, path):
+        key = file_key(path)
+        face = self.prepared_cache.get(key)
+
+        if face is None:
+            im = self._read_im(path)
+
+            if im is None:
+                landmarks = []
+            else:
+                landmarks = self._cached_landmarks(path, im)
+
+            face = self.prepare(im, landmarks, path)
+            self.prepared_cache.set(key, face)
+
+        return face
+
+    # Swap the face(s) of the face image on the head image, both given
+    # as BGR arrays, and return the result as a BGR uint8 array
+    def swap_images(self, head_im, face_im, order = None, order_repeat = False,
+        head_landmarks = None, face_landmarks = None
+    ):
+        return self.swap_prepared(
+            self.prepare(head_im, head_landmarks),
+            self.prepare(face_im, face_landmarks),
+            order = order,
+            order_repeat = order_repeat
+        )
+
+    # Like swap_images, but with a PreparedFace for head and face
+    def swap_prepared(self, head, face, order = None, order_repeat = False):
+        logger.debug(f"Order: {order}")
+
+        landmarks1 = head.landmarks
+        landmarks2 = face.landmarks
+
+        if len(landmarks1) == 0 or len(landmarks2) == 0:
             raise NoFacesError
 
         logger.debug(f"Landmarks found: head:{len(landmarks1)}, face:{len(landmarks2)}")
         logger.debug(f"Repeat order? {order_repeat}")
 
-        output_im = im1
+        output_im = head.im.copy()
 
         for index1 in range(0, len(landmarks1)):
             if order:
@@ -295,24 +446,74 @@ class Faceswap:
                 continue
 
             M = self._transformation_from_points(
-                landmarks1[index1][ALIGN_POINTS],
-                landmarks2[index2][ALIGN_POINTS]
+                head.align_points[index1],
+                face.align_points[index2]
             )
 
-            mask = self._get_face_mask(im2, landmarks2[index2])
-            warped_mask = self._warp_im(mask, M, im1.shape)
+            self._swap_face(output_im, head, face, index1, index2, M)
 
-            combined_mask = numpy.max(
-                [self._get_face_mask(im1, landmarks1[index1]), warped_mask],
-                axis=0
-            )
-
-            warped_im2 = self._warp_im(im2, M, im1.shape)
-
-            warped_corrected_im2 = self._correct_colours(
-                im1, warped_im2, landmarks1[index1]
-            )
-
-            output_im = output_im * (1.0 - combined_mask) + warped_corrected_im2 * combined_mask
+        return output_im
 
-        cv2.imwrite(output, output_im)
\ No newline at end of file
+    # Blend a face of face.im on output_im, but only within the region of
+    # head.im that the masks of both faces can cover. Everything outside of
+    # that would be blended with a mask of zero anyway
+    def _swap_face(self, output_im, head, face, index1, index2, M):
+        im1 = head.im
+        im2 = face.im
+        mask1, offset1 = head.masks[index1]
+        mask2, offset2 = face.masks[index2]
+        blur_amount = head.blur_amounts[index1]
+
+        # Blurring a mask twice with the feather kernel grows it by this much
+        grow = 2 * (self.feather // 2)
+
+        points1 = numpy.asarray(head.landmarks[index1])[self.overlay_indexes]
+        points2 = numpy.asarray(face.landmarks[index2])[self.overlay_indexes]
+
+        # The mask of the face in im2, and where that ends up in im1. M maps
+        # im1 coordinates to im2 coordinates
+        mx0, my0, mx1, my1 = self._bounds(points2, grow, im2.shape)
+        corners = numpy.array([
+            [mx0, mx1, mx0, mx1], [my0, my0, my1, my1], [1, 1, 1, 1]
+        ])
+        warped_corners = numpy.dot(numpy.linalg.inv(numpy.asarray(M)), corners)[:2].T
+
+        bounds1 = self._bounds(points1, grow, im1.shape)
+        bounds2 = self._bounds(warped_corners, 1, im1.shape)
+        x0, y0 = min(bounds1[0], bounds2[0]), min(bounds1[1], bounds2[1])
+        x1, y1 = max(bounds1[2], bounds2[2]), max(bounds1[3], bounds2[3])
+
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # A canvas around the region we blend that has room for the colour
+        # correction blur, and the region within that canvas
+        margin = blur_amount // 2 + 1
+        cx0, cy0 = max(x0 - margin, 0), max(y0 - margin, 0)
+        cx1, cy1 = min(x1 + margin, im1.shape[1]), min(y1 + margin, im1.shape[0])
+        canvas_shape = (cy1 - cy0, cx1 - cx0)
+        inner = (slice(y0 - cy0, y1 - cy0), slice(x0 - cx0, x1 - cx0))
+
+        # Shift M so it maps from canvas coordinates, and from region
+        # coordinates to the mask of the face
+        M_canvas = numpy.array(M[:2], dtype=numpy.float64)
+        M_canvas[:, 2] += numpy.dot(M_canvas[:, :2], [cx0, cy0])
+        M_mask = numpy.array(M[:2], dtype=numpy.float64)
+        M_mask[:, 2] += numpy.dot(M_mask[:, :2], [x0, y0]) - offset2
+
+        warped_mask = self._warp_im(mask2, M_mask, (y1 - y0, x1 - x0))
+
+        combined_mask = numpy.maximum(
+            self._crop_mask(mask1, offset1, (x0, y0, x1, y1)),
+            warped_mask
+        )[..., numpy.newaxis]
+
+        warped_im2 = self._warp_im(im2, M_canvas, canvas_shape + (3,))
+
+        warped_corrected_im2 = self._correct_colours(
+            im1[cy0:cy1, cx0:cx1], warped_im2, blur_amount, inner
+        )
+
+        region = output_im[y0:y1, x0:x1].astype(numpy.float32)
+        region = region * (1.0 - combined_mask) + warped_corrected_im2 * combined_mask
+        output_im[y0:y1, x0:x1] = numpy.clip(numpy.rint(region), 0, 255)
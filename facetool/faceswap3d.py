@@ -1,17 +1,46 @@
 # Code adapted from < https://github.com/wuhuikai/FaceSwap >
-from . import config
-from .constants import FEATHER_AMOUNT, BLUR_AMOUNT
+from .cache import (LandmarkCache, LRUCache, detect_landmarks, file_key,
+                    fingerprint, get_detection_cache)
+from .constants import (FEATHER_AMOUNT, BLUR_AMOUNT, PREPARED_CACHE_BYTES,
+                        PREPARED_CACHE_SIZE)
+from .detector import FaceDetector
+from .models import get_predictor
 from .errors import TooManyFacesError, NoFacesError
 
 import logging
 import cv2
-import dlib
 import numpy as np
 import scipy.spatial as spatial
 import logging
 
 logger = logging.getLogger(__name__)
 
+"""
+An image with everything about its face that doesn't depend on the other
+image in a swap: the landmarks, the region around the face and its mask.
+Prepare an image once and reuse it for all the swaps it's part of.
+"""
+class PreparedFace:
+    def __init__(self, im, landmarks, path = None):
+        self.im = im
+        self.landmarks = landmarks
+        self.path = path
+
+        # These are only set when there is exactly one face
+        self.points = None
+        self.shape = None
+        self.face = None
+        self.mask = None
+
+    @property
+    def nbytes(self):
+        nbytes = self.im.nbytes if self.im is not None else 0
+
+        if self.mask is not None:
+            nbytes = nbytes + self.mask.nbytes
+
+        return nbytes
+
 class Faceswap3d:
     def __init__(self,
         predictor_path,
@@ -30,9 +59,10 @@ class Faceswap3d:
         self.predictor_path = predictor_path
         self.correct_color = correct_color
         self.warp_3d = warp_3d
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(self.predictor_path)
-        self.landmark_hashes = {}
+        self.detector = FaceDetector()
+        self.predictor = get_predictor(self.predictor_path)
+        self.landmark_cache = LandmarkCache()
+        self.prepared_cache = LRUCache(PREPARED_CACHE_SIZE, PREPARED_CACHE_BYTES)
 
     ## 3D Transform
     def _bilinear_interpolate(self, img, coords):
@@ -217,39 +247,32 @@ class Faceswap3d:
 
         return result_img
 
+    # Returns a (faces, 68, 2) array with the landmarks of every face
     def _get_face_landmarks(self, im):
         # This is by far the slowest part of the whole algorithm, so we
         # cache the landmarks if the image is the same, especially when
         # dealing with videos this makes things twice as fast
-        img_hash = str(abs(hash(im.data.tobytes())))
+        img_hash = fingerprint(im)
+        landmarks = self.landmark_cache.get(img_hash)
 
-        if config.CACHE_LANDMARKS and img_hash in self.landmark_hashes:
+        if landmarks is not None:
             logging.debug("Landmarks are cached, return those")
-            return self.landmark_hashes[img_hash]
-
-        faces = self.detector(im)
-
-        if len(faces) > 1:
-            raise TooManyFacesError
-        elif len(faces) == 0:
-            raise NoFacesError
-        else:
-            bbox = faces[0]
-
-        # Get the landmarks/parts for the face in box d.
-        shape = self.predictor(im, bbox)
+            return landmarks
 
-        # loop over the 68 facial landmarks and convert them
-        # to a 2-tuple of (x, y)-coordinates
-        points = np.asarray(list([p.x, p.y] for p in shape.parts()), dtype=np.int)
+        rects, landmarks = detect_landmarks(im, self.detector, self.predictor, 0)
 
         # Save to image cache
-        self.landmark_hashes[img_hash] = points
+        self.landmark_cache.set(img_hash, landmarks)
 
-        return points
+        return landmarks
 
-    def _select_face(self, im, r = 10):
-        points = self._get_face_landmarks(im)
+    def _select_face(self, im, landmarks, r = 10):
+        if len(landmarks) > 1:
+            raise TooManyFacesError
+        elif len(landmarks) == 0:
+            raise NoFacesError
+        else:
+            points = np.asarray(landmarks[0], dtype=np.int)
 
         im_w, im_h = im.shape[:2]
         left, top = np.min(points, 0)
@@ -260,17 +283,84 @@ class Faceswap3d:
 
         return points - np.asarray([[x, y]]), (x, y, w, h), im[y:y+h, x:x+w]
 
+    # Landmarks of an image file from the on-disk detection cache, or None
+    # if that isn't enabled
+    def _cached_landmarks(self, fname, im):
+        cache = get_detection_cache()
+
+        if not cache:
+            return None
+
+        rects, landmarks = cache.landmarks(fname, 0, self.predictor_path,
+            lambda: detect_landmarks(im, self.detector, self.predictor, 0)
+        )
+
+        return landmarks
+
     def faceswap(self, head, face, output, order = None, order_repeat = False):
         logger.debug(f"Faceswap {head} on {face} as {output}")
 
-        src_img = cv2.imread(face)
-        dst_img = cv2.imread(head)
+        output_data = self.swap_prepared(
+            self.prepare_path(head),
+            self.prepare_path(face)
+        )
+
+        cv2.imwrite(output, output_data)
+
+    # Landmarks can also be given (e.g. by a tracker), as a list with a
+    # (68, 2) array for every face
+    def prepare(self, im, landmarks = None, path = None):
+        if landmarks is None:
+            landmarks = self._get_face_landmarks(im)
+
+        face = PreparedFace(im, landmarks, path)
 
-        # Select src face
-        src_points, src_shape, src_face = self._select_face(src_img)
+        if len(landmarks) == 1:
+            face.points, face.shape, face.face = self._select_face(im, landmarks)
+            face.mask = self._mask_from_points(face.face.shape[:2], face.points)
 
-        # Select dst face
-        dst_points, dst_shape, dst_face = self._select_face(dst_img)
+        return face
+
+    # Prepare an image file, images that were prepared before (and haven't
+    # changed since) are returned from the cache
+    def prepare_path(self, path):
+        key = file_key(path)
+        face = self.prepared_cache.get(key)
+
+        if face is None:
+            im = cv2.imread(path)
+
+            if im is None:
+                landmarks = []
+            else:
+                landmarks = self._cached_landmarks(path, im)
+
+            face = self.prepare(im, landmarks, path)
+            self.prepared_cache.set(key, face)
+
+        return face
+
+    # Swap the face of the face image on the head image, both given
+    # as BGR arrays, and return the result as a BGR uint8 array
+    def swap_images(self, head_im, face_im, order = None, order_repeat = False,
+        head_landmarks = None, face_landmarks = None
+    ):
+        return self.swap_prepared(
+            self.prepare(head_im, head_landmarks),
+            self.prepare(face_im, face_landmarks)
+        )
+
+    # Like swap_images, but with a PreparedFace for head and face
+    def swap_prepared(self, head, face, order = None, order_repeat = False):
+        for prepared in (head, face):
+            if len(prepared.landmarks) > 1:
+                raise TooManyFacesError
+            elif len(prepared.landmarks) == 0:
+                raise NoFacesError
+
+        dst_img = head.im
+        src_points, src_shape, src_face = face.points, face.shape, face.face
+        dst_points, dst_shape, dst_face = head.points, head.shape, head.face
 
         h, w = dst_face.shape[:2]
 
@@ -282,8 +372,7 @@ class Faceswap3d:
         else:
             logging.debug(f"Warping in 2d")
             ## 2d warp
-            src_mask = self._mask_from_points(src_face.shape[:2], src_points)
-            src_face = self._apply_mask(src_face, src_mask)
+            src_face = self._apply_mask(src_face, face.mask)
 
             # Correct Color for 2d warp
             if self.correct_color:
@@ -298,7 +387,7 @@ class Faceswap3d:
             )
 
         ## Mask for blending
-        mask = self._mask_from_points((h, w), dst_points)
+        mask = head.mask
         mask_src = np.mean(warped_src_face, axis=2) > 0
         mask = np.asarray(mask * mask_src, dtype=np.uint8)
 
@@ -320,6 +409,5 @@ class Faceswap3d:
         x, y, w, h = dst_shape
         dst_img_cp = dst_img.copy()
         dst_img_cp[y:y+h, x:x+w] = output_data
-        output_data = dst_img_cp
 
-        cv2.imwrite(output, output_data)
\ No newline at end of file
+        return dst_img_cp
\ No newline at end of file
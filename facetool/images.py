@@ -0,0 +1,50 @@
+import cv2
+import logging
+from .cache import LRUCache, file_key
+from .constants import IMAGE_CACHE_BYTES, IMAGE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# cv2.imread flags for decoding at 1/1, 1/2, 1/4 and 1/8 of the size. For
+# JPEG files the decoder does this itself, which is a lot faster than
+# decoding the full image and resizing it afterwards
+REDUCED_FLAGS = {
+    1 : cv2.IMREAD_COLOR,
+    2 : cv2.IMREAD_REDUCED_COLOR_2,
+    4 : cv2.IMREAD_REDUCED_COLOR_4,
+    8 : cv2.IMREAD_REDUCED_COLOR_8
+}
+
+_images = LRUCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_BYTES)
+
+"""
+Decodes an image file to a BGR array. Decoded images are kept in a small
+cache, so when detection, landmarking and drawing the output all need the
+same file it's only decoded once. The same array is returned every time,
+so make a copy before drawing on it. Use reduce (2, 4 or 8) to get a
+smaller version of the image for stages that don't need the full size.
+"""
+def read_image(path, reduce = 1):
+    path = str(path)
+    key = (file_key(path), reduce)
+    im = _images.get(key)
+
+    if im is None:
+        logger.debug(f"Decoding {path} at 1/{reduce} of the size")
+        im = cv2.imread(path, REDUCED_FLAGS[reduce])
+
+        if im is None:
+            raise IOError(f"Could not read image {path}")
+
+        _images.set(key, im)
+
+    return im
+
+# Returns the largest reduction we can decode with to get an image that is
+# at least scale times the original size
+def reduction(scale):
+    for reduce in (8, 4, 2):
+        if 1 / reduce >= scale:
+            return reduce
+
+    return 1
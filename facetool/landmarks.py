@@ -1,66 +1,72 @@
-from skimage import io
-from .util import rect_to_bb, Point
-from imutils import face_utils
+from .cache import detect_landmarks, get_detection_cache
+from .detector import FaceDetector
+from .images import read_image
+from .models import get_predictor
 import cv2
-import dlib
 import logging
+import numpy as np
 logger = logging.getLogger(__name__)
 
+# Normalize (faces, points, 2) landmarks to a number between 0 - 1 within
+# the (faces, 4) boxes of their faces
+def normalize_landmarks(landmarks, boxes):
+    origin = boxes[:, np.newaxis, :2]
+    size = boxes[:, np.newaxis, 2:] - origin
+    return ((landmarks - origin) / size).astype(np.float32)
+
 class Landmarks:
     def __init__(self, predictor_path, normalize_coords = False):
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(predictor_path)
+        self.detector = FaceDetector()
+        self.predictor_path = predictor_path
+        self.predictor = get_predictor(predictor_path)
         self.normalize_coords = normalize_coords
 
-    def _get_faces(self, image):
-        logging.debug(f"Getting faces for {image}")
-        img = io.imread(image)
-        faces = self.detector(img)
-
-        if len(faces) == 0:
-            logging.debug(f"No faces in {image}")
-
-        return len(faces), faces, img
+    def _detect(self, path):
+        logging.debug(f"Getting faces for {path}")
+        img = read_image(path)
+        return detect_landmarks(img, self.detector, self.predictor, 0)
 
-    # Normalize points to a number between 0 - 1
-    def _normalize(self, shape, face):
-        box = rect_to_bb(face)
+    # Returns the boxes of all faces as a (faces, 4) int32 array of (left,
+    # top, right, bottom) and their landmarks as a (faces, 68, 2) array,
+    # int32 pixel coordinates or float32 when normalizing
+    def get_all_landmarks(self, path, outpath = False):
+        cache = get_detection_cache()
 
-        def _coord(p):
-            return Point(
-                (p.x - box.x) / box.w,
-                (p.y - box.y) / box.h
+        if cache:
+            boxes, landmarks = cache.landmarks(
+                path, 0, self.predictor_path, lambda: self._detect(path)
             )
+        else:
+            boxes, landmarks = self._detect(path)
 
-        return [_coord(p) for p in shape]
-
-    def get_landmarks(self, path, outpath = False):
-        nr_of_faces, faces, img = self._get_faces(path)
-
-        if nr_of_faces == 0:
+        if len(boxes) == 0:
             logging.debug(f"No faces found for {path}")
-            return False
 
-        # For now, we only deal with the first face with multiple faces
-        if nr_of_faces > 1:
-            logging.warning("Detected multiple faces, using the first one")
+        if outpath:
+            logging.debug(f"Saving to {outpath}")
+            out = read_image(path).copy()
 
-        face = faces[0]
-        shape = self.predictor(img, face)
+            # Also create an image with landmark dots
+            for x, y in landmarks.reshape(-1, 2).tolist():
+                cv2.circle(out, (x, y), 3, (0, 0, 255), -1)
+
+            cv2.imwrite(outpath, out)
 
         if self.normalize_coords:
-            shape = self._normalize(shape, face)
+            landmarks = normalize_landmarks(landmarks, boxes)
 
-        if outpath:
-            logging.debug(f"Saving to {outpath}")
-            out = cv2.imread(path, cv2.IMREAD_COLOR)
+        return boxes, landmarks
 
-            # Also create an image with bounding box and landmarkd dots
-            shape_np = face_utils.shape_to_np(shape)
+    # Returns the (68, 2) landmarks of the first face, or None when there
+    # are no faces
+    def get_landmarks(self, path, outpath = False):
+        boxes, landmarks = self.get_all_landmarks(path, outpath)
 
-            for (x, y) in shape_np:
-                cv2.circle(out, (x, y), 3, (0, 0, 255), -1)
+        if len(landmarks) == 0:
+            return None
 
-            cv2.imwrite(outpath, out)
+        # For now, we only deal with the first face with multiple faces
+        if len(landmarks) > 1:
+            logging.warning("Detected multiple faces, using the first one")
 
-        return shape.parts()
\ No newline at end of file
+        return landmarks[0]
@@ -0,0 +1,170 @@
+from glob import glob
+from .constants import LANDMARK_CHUNK_SIZE
+import logging
+import numpy as np
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Every chunk has one .npy file for every column, with a row per face
+COLUMNS = ("path", "face", "box", "landmarks")
+PATHS_FILENAME = "paths.txt"
+
+def _save(path, arr):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arr)
+
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+# Returns the number of lines in a file, after cutting off a last line
+# without a newline, which is left when writing was interrupted
+def _complete_lines(path):
+    count, end = 0, 0
+
+    with open(path, "r+b") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+
+            count = count + 1
+            end = end + len(line)
+
+        f.truncate(end)
+
+    return count
+
+"""
+Writes landmarks to a directory as they are calculated, so memory doesn't
+grow with the number of images and everything that was written survives
+when a run is interrupted. The directory looks like this:
+
+    paths.txt               One image path per line, the line number is
+                            the path index
+    00000.path.npy          (faces,) int32 path index of every face
+    00000.face.npy          (faces,) int16 index of the face in its image
+    00000.box.npy           (faces, 4) int32 left, top, right, bottom
+    00000.landmarks.npy     (faces, 68, 2) int32, or float32 when normalized
+
+Rows are buffered and written as a new chunk every chunk_size faces. Every
+file of a chunk is written to a temporary file first and then renamed.
+Writing to an existing directory adds new chunks.
+"""
+class LandmarkWriter:
+    def __init__(self, directory, chunk_size = LANDMARK_CHUNK_SIZE):
+        self.directory = str(directory)
+        self.chunk_size = chunk_size
+        os.makedirs(self.directory, exist_ok = True)
+
+        paths_path = f"{self.directory}/{PATHS_FILENAME}"
+
+        if os.path.exists(paths_path):
+            self.path_count = _complete_lines(paths_path)
+        else:
+            self.path_count = 0
+
+        self.chunk = len(_chunks(self.directory))
+        self._paths = open(paths_path, "a")
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reset(self):
+        self._rows = { name : [] for name in COLUMNS }
+        self.buffered = 0
+
+    # Add the (faces, 4) boxes and (faces, 68, 2) landmarks of an image.
+    # The path is flushed right away, so a run that dies doesn't leave half
+    # a path that the next run would append to
+    def add(self, path, boxes, landmarks):
+        index = self.path_count
+        self._paths.write(f"{path}\n")
+        self._paths.flush()
+        self.path_count = self.path_count + 1
+
+        faces = len(boxes)
+
+        if faces == 0:
+            return
+
+        self._rows["path"].append(np.full(faces, index, dtype = np.int32))
+        self._rows["face"].append(np.arange(faces, dtype = np.int16))
+        self._rows["box"].append(np.asarray(boxes, dtype = np.int32))
+        self._rows["landmarks"].append(np.asarray(landmarks))
+        self.buffered = self.buffered + faces
+
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self._paths.close()
+
+    def flush(self):
+        # Make sure all paths the rows refer to are on disk first
+        self._paths.flush()
+
+        if self.buffered == 0:
+            return
+
+        prefix = f"{self.directory}/{str(self.chunk).zfill(5)}"
+        logging.debug(f"Writing {self.buffered} faces to {prefix}")
+
+        for name in COLUMNS:
+            _save(f"{prefix}.{name}.npy", np.concatenate(self._rows[name]))
+
+        self.chunk = self.chunk + 1
+        self._reset()
+
+# Prefixes of all chunks in a directory that have been written completely
+def _chunks(directory):
+    prefixes = sorted(
+        path[:-len(".path.npy")] for path in glob(f"{directory}/*.path.npy")
+    )
+
+    return [
+        prefix for prefix in prefixes
+        if all(os.path.exists(f"{prefix}.{name}.npy") for name in COLUMNS)
+    ]
+
+"""
+Reads landmarks written by LandmarkWriter. Chunks are memory mapped, so
+only the parts that are actually used are read from disk.
+"""
+class LandmarkReader:
+    def __init__(self, directory):
+        self.directory = str(directory)
+
+        with open(f"{self.directory}/{PATHS_FILENAME}") as f:
+            self.paths = [line.rstrip("\n") for line in f]
+
+        self.chunks = _chunks(self.directory)
+
+    def __iter__(self):
+        for index in range(len(self.chunks)):
+            yield self.chunk(index)
+
+    def __len__(self):
+        return sum(len(chunk["path"]) for chunk in self)
+
+    # Returns a dict with a memory mapped array for every column
+    def chunk(self, index):
+        return {
+            name : np.load(f"{self.chunks[index]}.{name}.npy", mmap_mode = "r")
+            for name in COLUMNS
+        }
+
+    # All rows of one column as a single (in memory) array
+    def column(self, name):
+        return np.concatenate([chunk[name] for chunk in self])
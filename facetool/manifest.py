@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+"""
+Returns a stable key for a piece of work, parts can be anything that can
+be serialized to JSON (paths, file keys, parameters)
+"""
+def manifest_key(*parts):
+    data = json.dumps(parts, sort_keys = True, default = str)
+    return hashlib.blake2b(data.encode(), digest_size = 16).hexdigest()
+
+"""
+Keeps a record of finished work (swaps, extracted frames) in an append-only
+JSON lines file, so an interrupted job can be resumed by running it again.
+Every line is written and flushed as soon as a piece of work is done, so
+at most the item that was in progress when we got killed is lost. Outputs
+are recorded with their size, and only count as done when they still exist
+with the same size, so partially written files are done again.
+"""
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.exists(path):
+            self._load()
+
+        self._file = open(path, "a")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                # The last line could be cut off when we were killed
+                # while writing it
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.debug(f"Skipping broken manifest line: {line!r}")
+                    continue
+
+                self.entries[entry["key"]] = entry
+
+        logger.debug(f"Loaded {len(self.entries)} finished items from {self.path}")
+
+    def add(self, key, output = None):
+        entry = { "key" : key, "output" : output }
+
+        if output and os.path.exists(output):
+            entry["size"] = os.path.getsize(output)
+
+        self.entries[key] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def is_done(self, key):
+        entry = self.entries.get(key)
+
+        if not entry:
+            return False
+
+        # Work without an output file (e.g. an image without faces) is
+        # done when it's in the manifest
+        if "size" not in entry:
+            return True
+
+        output = entry["output"]
+
+        if not os.path.exists(output) or os.path.getsize(output) != entry["size"]:
+            logger.debug(f"{output} is missing or incomplete, doing it again")
+            return False
+
+        return True
+
+    def remove(self):
+        self.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -3,6 +3,7 @@ from pathlib import Path
 from .constants import DEFAULT_FRAMERATE, TEMP_AUDIO_FILENAME
 from .command import Command
 import ffmpeg
+import numpy as np
 import os
 import logging
 
@@ -11,12 +12,19 @@ logger = logging.getLogger(__name__)
 FRAME_FILENAME_LENGTH = 4
 
 def _getwh(path):
-    data = probe(path)
-    width = data["streams"][0]["width"]
-    height = data["streams"][0]["height"]
+    width, height = videosize(path)
     wh = f"{width}x{height}"
     return wh
 
+def _videostream(data):
+    # The first stream is not necessarily the video stream, e.g. with
+    # some .mov files it's the audio
+    for stream in data["streams"]:
+        if stream.get("codec_type") == "video":
+            return stream
+
+    return data["streams"][0]
+
 def _run(cmd):
     command = " ".join(cmd.compile())
     logging.debug(command)
@@ -61,6 +69,103 @@ def combineframes(inp, out, framerate = DEFAULT_FRAMERATE):
 
     _run(cmd)
 
+"""
+Joins videos with the same codec and size without re-encoding them, using
+the concat demuxer. When an audio file (or a video with an audio track) is
+given it's muxed in the same run. Does something like this:
+
+ffmpeg -f concat -safe 0 -i list.txt -i audio.wav -c:v copy -c:a aac -b:a 192k -shortest out.mp4
+"""
+def concatvideos(paths, out, audio = None):
+    listfile = f"{out}.concat.txt"
+
+    with open(listfile, "w") as f:
+        for path in paths:
+            path = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+
+    streams = [ffmpeg.input(listfile, f = "concat", safe = 0).video]
+    kwargs = { "vcodec" : "copy" }
+
+    if audio:
+        # The '?' makes the audio optional, so videos without an audio
+        # track still work
+        streams.append(ffmpeg.input(audio)["a?"])
+        kwargs.update({
+            "acodec" : "aac",
+            "audio_bitrate" : "192k",
+            "shortest" : None
+        })
+
+    try:
+        _run(ffmpeg.output(*streams, out, **kwargs).overwrite_output())
+    finally:
+        os.remove(listfile)
+
+def duration(inp):
+    return float(probe(inp)["format"]["duration"])
+
+"""
+Encodes BGR frames (numpy arrays) written to it through an ffmpeg pipe,
+without writing the frames to disk first. When an audio file (or a video
+with an audio track) is given it's muxed in the same ffmpeg run.
+"""
+class FrameWriter:
+    def __init__(self, out, width, height,
+        framerate = DEFAULT_FRAMERATE,
+        audio = None
+    ):
+        streams = [
+            ffmpeg.input("pipe:",
+                format = "rawvideo",
+                pix_fmt = "bgr24",
+                s = f"{width}x{height}",
+                framerate = framerate
+            )
+        ]
+
+        kwargs = {
+            "vcodec" : "libx264",
+            "crf" : "25",
+            "pix_fmt" : "yuv420p"
+        }
+
+        if audio:
+            streams.append(ffmpeg.input(audio)["a?"])
+            kwargs.update({
+                "acodec" : "aac",
+                "audio_bitrate" : "192k",
+                "shortest" : None
+            })
+
+        cmd = ffmpeg.output(*streams, out, **kwargs).overwrite_output()
+        logging.debug(" ".join(cmd.compile()))
+        self.process = cmd.global_args("-loglevel", "error").run_async(
+            pipe_stdin = True
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            # Writing failed, stop ffmpeg without hiding that error
+            self.process.kill()
+            self.process.wait()
+        else:
+            self.close()
+
+    # Raises ffmpeg.Error when encoding failed, like _run, so a failed or
+    # truncated video isn't reported as a success
+    def close(self):
+        self.process.stdin.close()
+
+        if self.process.wait() != 0:
+            raise ffmpeg.Error("ffmpeg", None, None)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.astype(np.uint8, copy = False).tobytes())
+
 def extractaudio(inp, out):
     # Extract audio as a WAV, because re-adding it as MP3 somehow
     # doesn't work
@@ -84,5 +189,95 @@ def is_image(inp):
 def is_video(inp):
     return not is_image(inp)
 
+# Timestamps (in seconds) of all keyframes of the first video stream. Only
+# keyframes are decoded, so this is fast even for long videos
+def keyframes(inp):
+    data = ffmpeg.probe(inp,
+        select_streams = "v:0",
+        skip_frame = "nokey",
+        show_entries = "frame=pts_time,best_effort_timestamp_time"
+    )
+
+    times = []
+
+    for frame in data.get("frames", []):
+        time = frame.get("pts_time", frame.get("best_effort_timestamp_time"))
+
+        if time is not None:
+            times.append(float(time))
+
+    return sorted(times)
+
+"""
+Splits a video in (at most) count segments of about the same length that
+all start at a keyframe, so every segment can be decoded on its own. Returns
+a list of (start, length) tuples in seconds, the length of the last segment
+is None, meaning 'until the end'.
+"""
+def keyframe_segments(inp, count):
+    total = duration(inp)
+    times = keyframes(inp)
+    starts = [0.0]
+
+    for index in range(1, count):
+        target = total * index / count
+        later = [t for t in times if t >= target and t > starts[-1]]
+
+        if later:
+            starts.append(later[0])
+
+    lengths = [end - start for start, end in zip(starts, starts[1:])] + [None]
+    return list(zip(starts, lengths))
+
 def probe(inp = None):
-    return ffmpeg.probe(inp)
\ No newline at end of file
+    return ffmpeg.probe(inp)
+
+# Not all containers have the number of frames in their metadata, in that
+# case this returns None
+def framecount(inp):
+    frames = _videostream(probe(inp)).get("nb_frames")
+    return int(frames) if frames else None
+
+def framerate(inp):
+    rate = _videostream(probe(inp))["r_frame_rate"]
+    num, den = rate.split("/")
+    return int(num) / int(den)
+
+"""
+Decodes all frames of a video as BGR numpy arrays through an ffmpeg pipe,
+so no frames are written to disk. Frames are yielded in order. Give start
+and length (in seconds) to only decode a part of the video.
+"""
+def readframes(inp, start = None, length = None):
+    width, height = videosize(inp)
+    framesize = width * height * 3
+    kwargs = {}
+
+    if start:
+        kwargs["ss"] = start
+
+    if length:
+        kwargs["t"] = length
+
+    cmd = ffmpeg.input(inp, **kwargs).output("pipe:", format = "rawvideo", pix_fmt = "bgr24")
+    logging.debug(" ".join(cmd.compile()))
+    process = cmd.global_args("-loglevel", "error", "-nostdin").run_async(
+        pipe_stdout = True
+    )
+
+    try:
+        while True:
+            buf = process.stdout.read(framesize)
+
+            if len(buf) < framesize:
+                break
+
+            yield np.frombuffer(buf, np.uint8).reshape((height, width, 3))
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+def videosize(inp):
+    stream = _videostream(probe(inp))
+    return stream["width"], stream["height"]
\ No newline at end of file
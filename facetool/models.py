@@ -0,0 +1,47 @@
+import dlib
+import logging
+import threading
+from . import config
+
+logger = logging.getLogger(__name__)
+
+"""
+Process-wide registry of loaded models. Loading the 68 point shape predictor
+alone takes about a second, so every detector, predictor and session is
+loaded once per process the first time it's asked for, and then shared by
+everything that needs it (landmarks, poses, swaps, classification).
+"""
+_models = {}
+_lock = threading.Lock()
+
+# Returns the model for key, calling load() to create it the first time
+def get_model(key, load):
+    with _lock:
+        if key not in _models:
+            logger.debug(f"Loading model {key}")
+            _models[key] = load()
+
+        return _models[key]
+
+def get_frontal_face_detector():
+    return get_model(("hog",), dlib.get_frontal_face_detector)
+
+def get_predictor(path):
+    path = str(path)
+    return get_model(("predictor", path), lambda: dlib.shape_predictor(path))
+
+"""
+Hook for worker processes: loads the models a worker needs in one go when
+it sets itself up, before it starts on its first job. Call it after the
+configuration of the main process has been applied. With encoder, the face_recognition models (that are
+loaded when it's imported) are loaded as well.
+"""
+def preload(predictor_path = None, encoder = False):
+    if config.DETECTOR_BACKEND == "hog":
+        get_frontal_face_detector()
+
+    if predictor_path:
+        get_predictor(predictor_path)
+
+    if encoder:
+        import face_recognition
@@ -1,38 +1,50 @@
 import sys
 import os
-import dlib
 import glob
 import cv2
-import numpy as np
 import logging
+from .cache import detect_landmarks, get_detection_cache
+from .detector import FaceDetector
 from .facepose import detect_pose
-from skimage import io
+from .images import read_image
+from .models import get_predictor
 
 logger = logging.getLogger(__name__)
 
 class Poser:
     def __init__(self, predictor_path):
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(predictor_path)
+        self.detector = FaceDetector()
+        self.predictor_path = predictor_path
+        self.predictor = get_predictor(predictor_path)
+
+    # Returns a (faces, 68, 2) array with the landmarks of all faces
+    def _get_shapes(self, f, img):
+        cache = get_detection_cache()
+        detect = lambda: detect_landmarks(img, self.detector, self.predictor, 1)
+
+        if cache:
+            rects, landmarks = cache.landmarks(f, 1, self.predictor_path, detect)
+        else:
+            rects, landmarks = detect()
+
+        return landmarks
 
     def get_poses(self,
         f, outpath = None, draw_points = True, draw_direction_line = True
     ):
         logger.debug(f"Processing file {f}")
-        img = io.imread(f)
-        out = cv2.imread(f, cv2.IMREAD_COLOR)
+        img = read_image(f)
+        out = img.copy()
 
-        detects = self.detector(img, 1)
-        logger.debug(f"Number of faces detected: {len(detects)}")
+        shapes = self._get_shapes(f, img)
+        logger.debug(f"Number of faces detected: {len(shapes)}")
 
-        if len(detects) < 1:
+        if len(shapes) < 1:
             return False
 
         poses = []
 
-        for k, d in enumerate(detects):
-            shape = self.predictor(out, d).parts()
-
+        for shape in shapes:
             pose = detect_pose(
                 out,
                 shape,
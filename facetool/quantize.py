@@ -0,0 +1,220 @@
+import logging
+import numpy as np
+import os
+from .constants import (INDEX_TRAIN_SIZE, QUANTIZE_BLOCK_SIZE,
+                        QUANTIZE_PQ_CENTROIDS, QUANTIZE_PQ_SUBSPACES)
+from .distances import distance_blocks
+from .faceindex import kmeans, nearest_centroids
+
+logger = logging.getLogger(__name__)
+
+# encodings.npy has its compressed codes in encodings.codes.npz
+def codes_path(path):
+    return f"{os.path.splitext(str(path))[0]}.codes.npz"
+
+# Random rows of vectors (sorted, so a memory mapped array is read front to
+# back) to train a quantizer on
+def _sample(vectors, size, seed = 0):
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), min(len(vectors), size), replace = False))
+    return np.asarray(vectors[rows], dtype = np.float32)
+
+"""
+Stores every value as a half precision float, half the size of the
+encodings store and without any training.
+"""
+class Float16Quantizer:
+    kind = "float16"
+
+    def train(self, vectors):
+        return self
+
+    # Encodes a block of vectors at a time, so vectors can be a memory mapped
+    # array of any size
+    def encode(self, vectors):
+        return np.concatenate([
+            self._encode(np.asarray(vectors[start:start + QUANTIZE_BLOCK_SIZE], dtype = np.float32))
+            for start in range(0, len(vectors), QUANTIZE_BLOCK_SIZE)
+        ])
+
+    def _encode(self, vectors):
+        return vectors.astype(np.float16)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype = np.float32)
+
+    def params(self):
+        return {}
+
+    @classmethod
+    def from_params(cls, data):
+        return cls()
+
+    # Euclidean distance of every code to query, decoding a block of codes
+    # at a time
+    def distances(self, codes, query):
+        distances = np.empty(len(codes), dtype = np.float32)
+        query = np.asarray(query, dtype = np.float32)[np.newaxis]
+
+        for _, start, block in distance_blocks(query, DecodedCodes(self, codes)):
+            distances[start:start + block.shape[1]] = block[0]
+
+        return distances
+
+"""
+Scalar quantization: every value becomes one byte, scaled between the
+minimum and maximum of its dimension in the training data. A quarter of the
+size of the encodings store.
+"""
+class ScalarQuantizer(Float16Quantizer):
+    kind = "sq8"
+
+    def __init__(self, low = None, scale = None):
+        self.low = low
+        self.scale = scale
+
+    def train(self, vectors):
+        sample = _sample(vectors, QUANTIZE_PQ_CENTROIDS * INDEX_TRAIN_SIZE)
+        self.low = sample.min(axis = 0)
+        self.scale = np.maximum(sample.max(axis = 0) - self.low, 1e-6) / 255
+        return self
+
+    def _encode(self, vectors):
+        codes = (vectors - self.low) / self.scale
+        return np.clip(np.rint(codes), 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype = np.float32) * self.scale + self.low
+
+    def params(self):
+        return { "low" : self.low, "scale" : self.scale }
+
+    @classmethod
+    def from_params(cls, data):
+        return cls(data["low"], data["scale"])
+
+"""
+Product quantization: the encoding is split in QUANTIZE_PQ_SUBSPACES parts,
+and every part is replaced by the index of its nearest centroid out of
+QUANTIZE_PQ_CENTROIDS, trained with k-means. With the defaults a 128
+dimension encoding takes 16 bytes instead of 512. Distances are calculated
+on the codes directly: the distances from the query to all centroids are
+calculated once, after that the distance to a code is a sum of table
+lookups.
+"""
+class ProductQuantizer(Float16Quantizer):
+    kind = "pq"
+
+    def __init__(self, codebooks = None):
+        # (subspaces, centroids, dimensions per subspace)
+        self.codebooks = codebooks
+
+    def train(self, vectors):
+        subspaces = QUANTIZE_PQ_SUBSPACES
+        sample = _sample(vectors, QUANTIZE_PQ_CENTROIDS * INDEX_TRAIN_SIZE)
+
+        if sample.shape[1] % subspaces:
+            raise ValueError(f"Can't split {sample.shape[1]} dimensions in {subspaces} parts")
+
+        centroids = min(QUANTIZE_PQ_CENTROIDS, len(sample))
+        logging.debug(f"Training {subspaces} x {centroids} centroids on {len(sample)} encodings")
+
+        self.codebooks = np.stack([
+            kmeans(part, centroids)
+            for part in np.split(sample, subspaces, axis = 1)
+        ])
+
+        return self
+
+    def _encode(self, vectors):
+        parts = np.split(vectors, len(self.codebooks), axis = 1)
+
+        return np.stack([
+            nearest_centroids(part, codebook)
+            for part, codebook in zip(parts, self.codebooks)
+        ], axis = 1).astype(np.uint8)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+
+        return np.concatenate([
+            codebook[codes[..., subspace]]
+            for subspace, codebook in enumerate(self.codebooks)
+        ], axis = -1)
+
+    def params(self):
+        return { "codebooks" : self.codebooks }
+
+    @classmethod
+    def from_params(cls, data):
+        return cls(data["codebooks"])
+
+    def distances(self, codes, query):
+        # Squared distance of every part of the query to every centroid of
+        # its subspace
+        parts = np.asarray(query, dtype = np.float32).reshape(len(self.codebooks), 1, -1)
+        table = ((self.codebooks - parts) ** 2).sum(axis = 2)
+        subspaces = np.arange(len(self.codebooks))
+        distances = np.empty(len(codes), dtype = np.float32)
+
+        for start in range(0, len(codes), QUANTIZE_BLOCK_SIZE):
+            block = codes[start:start + QUANTIZE_BLOCK_SIZE]
+            distances[start:start + len(block)] = table[subspaces, block].sum(axis = 1)
+
+        return np.sqrt(distances, out = distances)
+
+QUANTIZERS = {
+    q.kind : q for q in (Float16Quantizer, ScalarQuantizer, ProductQuantizer)
+}
+
+"""
+Read only view of compressed codes that looks like an array of encodings:
+slicing or indexing it gives the decoded (approximate) float32 encodings.
+Used by the encodings store when there are only codes, so everything that
+reads the encodings store works on the codes as well.
+"""
+class DecodedCodes:
+    def __init__(self, quantizer, codes):
+        self.quantizer = quantizer
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.quantizer.decode(self.codes[index])
+
+    def __array__(self, dtype = None, copy = None):
+        encodings = self.quantizer.decode(self.codes)
+        return encodings if dtype is None else encodings.astype(dtype)
+
+# Train a quantizer of the given kind on encodings and compress them
+def quantize(encodings, kind):
+    if len(encodings) == 0:
+        raise ValueError("Can't quantize without encodings")
+
+    quantizer = QUANTIZERS[kind]().train(encodings)
+    return quantizer, quantizer.encode(encodings)
+
+# fingerprint is the encodingstore.store_fingerprint of the store the codes
+# were made from
+def save_codes(path, quantizer, codes, fingerprint = None):
+    # Write to a temporary file first, like the encodings store
+    tmp_path = f"{path}.tmp.npz"
+
+    np.savez(tmp_path,
+        kind = quantizer.kind,
+        codes = codes,
+        fingerprint = fingerprint or "",
+        **quantizer.params()
+    )
+
+    os.replace(tmp_path, path)
+
+# Returns the quantizer, the codes and the fingerprint of the store, the
+# codes are small enough to keep in memory
+def load_codes(path):
+    data = np.load(path)
+    quantizer = QUANTIZERS[str(data["kind"])].from_params(data)
+    fingerprint = (str(data["fingerprint"]) or None) if "fingerprint" in data else None
+    return quantizer, data["codes"], fingerprint
@@ -1,69 +1,186 @@
+import dlib
 import face_recognition
 import json
 import logging
-import math
-from .constants import DEFAULT_TRESHOLD
+import numpy as np
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from .constants import (DEFAULT_TRESHOLD, ENCODE_BATCH_SIZE, INDEX_TOP_K,
+                        QUANTIZE_RERANK)
+from .encodingstore import ENCODING_SIZE, EncodingStore, EncodingWriter
+from .distances import nearest, pairs_within
+from .faceindex import FaceIndex, index_path
+from .models import preload
 from .path import Path
 from .errors import ArgumentError, FaceError
+from .util import message
 
 logger = logging.getLogger(__name__)
 
+# Size and padding of the face chips face_recognition uses for encoding
+FACE_CHIP_SIZE = 150
+FACE_CHIP_PADDING = 0.25
+
+"""
+Encodes all faces of a batch of images, the same way as
+face_recognition.face_encodings does. The faces of all images are cut out
+first, so the network calculates the descriptors of all of them at once.
+Returns a list of (path, (faces, 128) encodings, error) tuples, where error
+is a message when the image couldn't be encoded. This runs in worker
+processes, that all load the face_recognition models once when they
+start working (see _worker_encode_batch).
+"""
+def _encode_batch(paths):
+    api = face_recognition.api
+    results = []
+    chips = []
+
+    for path in paths:
+        try:
+            image = face_recognition.load_image_file(path)
+            shapes = dlib.full_object_detections()
+
+            for rect in api.face_detector(image, 1):
+                shapes.append(api.pose_predictor_5_point(image, rect))
+
+            if len(shapes) > 0:
+                chips.extend(dlib.get_face_chips(image, shapes,
+                    size = FACE_CHIP_SIZE,
+                    padding = FACE_CHIP_PADDING
+                ))
+        except Exception as e:
+            results.append([path, 0, f"{type(e).__name__}: {e}"])
+        else:
+            results.append([path, len(shapes), None])
+
+    if chips:
+        descriptors = np.array(
+            api.face_encoder.compute_face_descriptor(chips), dtype = np.float32
+        )
+    else:
+        descriptors = np.zeros((0, ENCODING_SIZE), dtype = np.float32)
+
+    start = 0
+
+    for result in results:
+        faces = result[1]
+        result[1] = descriptors[start:start + faces]
+        start = start + faces
+
+    return [tuple(result) for result in results]
+
+# Set when a worker process has loaded its models, on its first batch
+_encode_worker_ready = False
+
+def _worker_encode_batch(paths):
+    global _encode_worker_ready
+
+    if not _encode_worker_ready:
+        preload(encoder = True)
+        _encode_worker_ready = True
+
+    return _encode_batch(paths)
+
 class Recognizer:
-    def __init__(self, treshold = DEFAULT_TRESHOLD):
+    def __init__(self,
+        treshold = DEFAULT_TRESHOLD,
+        jobs = 1,
+        batch_size = ENCODE_BATCH_SIZE
+    ):
         self.treshold = DEFAULT_TRESHOLD
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.failures = []
 
-    def _encode_image_path(self, path):
-        # First get encodings from all images in the target path
-        encodings = {}
+    """
+    Yields (path, (faces, 128) encodings) tuples for all paths, in order.
+    Images are encoded in batches, with more than one job by a pool of
+    worker processes. Images that can't be encoded are reported, kept in
+    self.failures as (path, error) tuples, and yielded with None.
+    """
+    def _encode_many(self, paths):
+        batches = [
+            paths[i:i + self.batch_size] for i in range(0, len(paths), self.batch_size)
+        ]
 
-        image_paths = [str(p) for p in Path(path).images()]
+        for batch in self._map_batches(batches):
+            for path, encodings, error in batch:
+                if error:
+                    logging.warning(f"Could not encode {path}: {error}")
+                    self.failures.append((path, error))
+                    yield path, None
+                    continue
 
-        for imgpath in image_paths:
-            try:
-                encoding = self._encoding_from_image(imgpath)
-            except:
-                continue
+                logging.debug(f"Encoded {len(encodings)} faces of {path}")
+                yield path, encodings
 
-            encodings[imgpath] = encoding
+    # Only a limited number of batches is in flight at the same time, so
+    # memory stays flat with large libraries
+    def _map_batches(self, batches):
+        if self.jobs == 1:
+            for batch in batches:
+                yield _encode_batch(batch)
 
-        return encodings
+            return
 
-    # From:
-    # < https://github.com/ageitgey/face_recognition/wiki/Calculating-Accuracy-as-a-Percentage >
-    def _face_distance_to_conf(self, face_distance):
-        if face_distance > self.treshold:
-            range_ = (1.0 - self.treshold)
-            linear_val = (1.0 - face_distance) / (range_ * 2.0)
-            return linear_val
-        else:
-            range_ = self.treshold
-            linear_val = 1.0 - (face_distance / (range_ * 2.0))
-            return linear_val + ((1.0 - linear_val) * math.pow((linear_val - 0.5) * 2, 0.2))
+        pending = deque()
 
-    # Load one image, get the encoding and return that, but only if there
-    # is exactly *one* face
-    def _encoding_from_image(self, path):
-        logging.debug(f"Getting encoding for {path}")
-        image = face_recognition.load_image_file(path)
-        image_encodings = face_recognition.face_encodings(image)
+        with ProcessPoolExecutor(max_workers = self.jobs) as executor:
+            for batch in batches:
+                pending.append(executor.submit(_worker_encode_batch, batch))
 
-        if len(image_encodings) != 1:
-            raise FaceError(f"{path} has 0 or more than 1 face, skipping")
+                if len(pending) >= self.jobs * 2:
+                    yield pending.popleft().result()
 
-        return image_encodings[0]
+            while pending:
+                yield pending.popleft().result()
 
-    def encode_path(self, path, return_type = "json"):
-        encodings = {}
+    # Encodings of all images in path that have exactly one face
+    def _single_encodings(self, path):
         image_paths = [str(p) for p in Path(path).images()]
         logging.debug(f"Encoding {len(image_paths)} images")
 
-        for image_path in image_paths:
-            try:
-                encoding = self._encoding_from_image(image_path)
-            except:
+        for image_path, encodings in self._encode_many(image_paths):
+            if encodings is None:
+                continue
+
+            if len(encodings) != 1:
+                logging.debug(f"{image_path} has 0 or more than 1 face, skipping")
                 continue
 
-            encodings[image_path] = encoding.tolist()
+            yield image_path, encodings[0]
+
+    def _encode_image_path(self, path):
+        # First get encodings from all images in the target path
+        return dict(self._single_encodings(path))
+
+    def report_failures(self):
+        if self.failures:
+            message(f"Could not encode {len(self.failures)} images:")
+
+            for path, error in self.failures:
+                message(f"{path}: {error}")
+
+    # From:
+    # < https://github.com/ageitgey/face_recognition/wiki/Calculating-Accuracy-as-a-Percentage >
+    # Works on a single distance or on an array of them
+    def _face_distance_to_conf(self, face_distance):
+        face_distance = np.asarray(face_distance, dtype = np.float64)
+        above = face_distance > self.treshold
+
+        linear_above = (1.0 - face_distance) / ((1.0 - self.treshold) * 2.0)
+        linear_below = 1.0 - (face_distance / (self.treshold * 2.0))
+        curve = np.power(np.clip((linear_below - 0.5) * 2, 0, None), 0.2)
+        conf = np.where(above, linear_above, linear_below + (1.0 - linear_below) * curve)
+
+        return conf.item() if conf.ndim == 0 else conf
+
+    def encode_path(self, path, return_type = "json"):
+        encodings = {
+            image_path : encoding.tolist()
+            for image_path, encoding in self._single_encodings(path)
+        }
 
         logging.debug(f"Encoded {len(encodings.values())} images")
 
@@ -80,11 +197,49 @@ class Recognizer:
         else:
             raise ArgumentError(f"Invalid return_type: {return_type}")
 
+    # Encode all faces of all images in path to a binary encodings store,
+    # writing them while we go. When incremental is set and out already
+    # exists, only new and changed images are encoded, the encodings of the
+    # other images are copied and deleted images are dropped
+    def write_encodings(self, path, out, incremental = False):
+        image_paths = [str(p) for p in Path(path).images()]
+        logging.debug(f"Encoding {len(image_paths)} images to {out}")
+
+        if incremental and os.path.exists(out):
+            previous = EncodingStore.load(out)
+        else:
+            previous = EncodingStore.from_dict({})
+
+        digests = { p : previous.unchanged_digest(p) for p in image_paths }
+        changed = [p for p in image_paths if not digests[p]]
+        encoded = self._encode_many(changed)
+        reused = len(image_paths) - len(changed)
+
+        # Write images in the order of image_paths, failed images are
+        # left out, so they're tried again on the next run
+        with EncodingWriter(out) as writer:
+            for image_path in image_paths:
+                if digests[image_path]:
+                    writer.add(image_path,
+                        previous.encodings_of(image_path), digests[image_path]
+                    )
+                    continue
+
+                _, encodings = next(encoded)
+
+                if encodings is not None:
+                    writer.add(image_path, encodings)
+
+        removed = len(set(previous.files) - set(image_paths))
+        logging.debug(f"Stored {writer.count} faces, {reused} images unchanged, {removed} removed")
+
     def recognize(self,
         input_path,
         model_path = None,
         target_path = None,
-        as_percentage = False
+        as_percentage = False,
+        top_k = None,
+        max_distance = None
     ):
         if not any([model_path, target_path]):
             raise ArgumentError("Need either a model or a target path")
@@ -101,22 +256,157 @@ class Recognizer:
             # Take the first face
             input_encoding = input_encoding[0]
 
-        # If we have a model path, load those encodings, otherwise we need
-        # to calculate the target encodings
+        # If we have a model path, load those encodings (JSON or binary),
+        # otherwise we need to calculate the target encodings
+        index = None
+
         if model_path:
-            with open(model_path) as f:
-                encodings = json.load(f)["encodings"]
+            store = EncodingStore.load(model_path)
+            index = FaceIndex.load(index_path(model_path), store.encodings,
+                store.fingerprint
+            )
         elif target_path:
-            encodings = self._encode_image_path(target_path)
+            store = EncodingStore.from_dict(self._encode_image_path(target_path))
+
+        # With an index we only get the nearest faces, without we calculate
+        # the distance to all of them
+        if index:
+            logging.debug(f"Searching the index of {model_path}")
+            rows, distances = index.search(input_encoding,
+                k = top_k or INDEX_TOP_K,
+                max_distance = max_distance
+            )
+            paths = [store.paths[row] for row in rows]
+        elif store.codes is not None and (top_k or not store.exact):
+            logging.debug(f"Searching the {store.quantizer.kind} codes of {model_path}")
+            rows, distances = self._search_codes(store, input_encoding, top_k)
+            paths = [store.paths[row] for row in rows]
+        else:
+            distances = face_recognition.face_distance(store.encodings, input_encoding)
+            paths = store.paths
 
-        image_paths = list(encodings.keys())
-        results = face_recognition.face_distance(list(encodings.values()), input_encoding)
+        # A binary store can have multiple faces of an image, use the
+        # closest one
+        results = {}
+
+        for path, distance in zip(paths, distances.tolist()):
+            if max_distance is not None and distance > max_distance:
+                continue
+
+            if path not in results or distance < results[path]:
+                results[path] = distance
+
+        if top_k:
+            results = dict(sorted(results.items(), key = lambda x:x[1])[:top_k])
 
         if as_percentage:
             logging.debug("Converting all face distances to percentages")
-            results = [self._face_distance_to_conf(d) for d in results]
-
-        results = dict(zip(image_paths, results))
+            confs = self._face_distance_to_conf(list(results.values()))
+            results = dict(zip(results.keys(), np.atleast_1d(confs).tolist()))
 
         # Sort by value
-        return dict(sorted(results.items(), key = lambda x:x[1]))
\ No newline at end of file
+        return dict(sorted(results.items(), key = lambda x:x[1]))
+
+    # Distances from query to the compressed codes of a store. When we only
+    # need the top_k and still have the exact encodings, the closest
+    # candidates are re-ranked with their exact distance
+    def _search_codes(self, store, query, top_k):
+        distances = store.quantizer.distances(store.codes, query)
+        rows = np.arange(len(distances))
+        candidates = (top_k or 0) * QUANTIZE_RERANK
+
+        if store.exact and candidates:
+            if candidates < len(rows):
+                rows = np.sort(np.argpartition(distances, candidates - 1)[:candidates])
+
+            distances = np.linalg.norm(store.encodings[rows] - query, axis = 1)
+
+        return rows, distances
+
+    # Encodings of all faces in a directory of images, or from an encodings
+    # file
+    def _load_or_encode(self, path):
+        if os.path.isdir(path):
+            image_paths = [str(p) for p in Path(path).images()]
+            paths, faces, encodings = [], [], []
+
+            for image_path, image_encodings in self._encode_many(image_paths):
+                if image_encodings is None:
+                    continue
+
+                paths.extend([image_path] * len(image_encodings))
+                faces.extend(range(len(image_encodings)))
+                encodings.append(image_encodings)
+
+            return EncodingStore(
+                encodings = np.concatenate(encodings or [np.zeros((0, ENCODING_SIZE))]),
+                paths = paths,
+                faces = np.array(faces, dtype = np.int32)
+            )
+
+        return EncodingStore.load(path)
+
+    """
+    Compares all faces of input_path (a directory of images or an encodings
+    file) with all faces of model_path (an encodings file) or target_path
+    (a directory). Distances are calculated in blocks, so this works for
+    large sets on both sides. Yields a dict for every match, in the order
+    of the input faces: the top_k closest matches of every input face, or
+    when only max_distance is given, all pairs that are at least that close.
+    With top_k, input faces without any match get a dict with an empty
+    (None) match. When input and target are the same, faces are not matched with
+    themselves and every pair is only given once.
+    """
+    def recognize_many(self,
+        input_path,
+        model_path = None,
+        target_path = None,
+        as_percentage = False,
+        top_k = None,
+        max_distance = None
+    ):
+        if not any([model_path, target_path]):
+            raise ArgumentError("Need either a model or a target path")
+
+        target = model_path or target_path
+        probes = self._load_or_encode(input_path)
+        same = os.path.realpath(input_path) == os.path.realpath(target)
+        targets = probes if same else self._load_or_encode(target)
+
+        logging.debug(f"Comparing {len(probes)} faces to {len(targets)} faces")
+
+        if max_distance is not None and not top_k:
+            matches = pairs_within(probes.encodings, targets.encodings,
+                max_distance, exclude_self = same
+            )
+        else:
+            matches = self._top_matches(probes, targets, top_k, max_distance, same)
+
+        for probe, target, distance in matches:
+            if as_percentage and distance is not None:
+                distance = self._face_distance_to_conf(distance)
+
+            yield {
+                "input" : probes.paths[probe],
+                "input_face" : int(probes.faces[probe]),
+                "match" : None if target is None else targets.paths[target],
+                "match_face" : None if target is None else int(targets.faces[target]),
+                "distance" : distance
+            }
+
+    # Yields (probe, target, distance) for the top_k matches of every probe,
+    # and (probe, None, None) for probes without any match, so every input
+    # face is in the output
+    def _top_matches(self, probes, targets, top_k, max_distance, same):
+        found = nearest(probes.encodings, targets.encodings,
+            k = top_k or INDEX_TOP_K,
+            max_distance = max_distance,
+            exclude_self = same
+        )
+
+        for probe, rows, distances in found:
+            if len(rows) == 0:
+                yield probe, None, None
+
+            for target, distance in zip(rows.tolist(), distances.tolist()):
+                yield probe, target, distance
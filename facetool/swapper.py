@@ -1,18 +1,28 @@
 import logging
+import os
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
+from itertools import repeat
+from . import config
 from .path import Path
 from .constants import FEATHER_AMOUNT, BLUR_AMOUNT, TEMP_AUDIO_FILENAME
-from .media import is_image, is_video, extractframes, combineframes, extractaudio, combineaudio
+from .cache import file_key
+from .manifest import Manifest, manifest_key
+from .models import preload
+from .media import (is_image, is_video, extractframes, combineframes,
+                    extractaudio, combineaudio, concatvideos, framecount,
+                    framerate, keyframe_segments, readframes, videosize,
+                    FrameWriter)
 from .util import (force_mkdir, get_basename, numberize_files,
                   mkdir_if_not_exists, message, random_filename)
-from .errors import TooManyFacesError, NoFacesError, FaceError
+from .errors import ArgumentError, TooManyFacesError, NoFacesError, FaceError
 
 logger = logging.getLogger(__name__)
 
 class TempDirs:
-    def __init__(self, prefix):
+    def __init__(self, prefix, suffix = None):
         if not prefix:
             prefix = ""
 
@@ -22,7 +32,7 @@ class TempDirs:
             prefix = prefix + "/"
 
         self.prefix = prefix
-        self.suffix = random_filename()
+        self.suffix = suffix or random_filename()
         self.audio = f"{prefix}audio-tmp-{self.suffix}"
         self.head = f"{prefix}head-tmp-{self.suffix}"
         self.face = f"{prefix}face-tmp-{self.suffix}"
@@ -30,6 +40,145 @@ class TempDirs:
         self.img_to_video = (self.head, self.out)
         self.video_to_video = (self.head, self.out, self.face, self.audio)
 
+THREAD_WORKERS = 20
+
+# Swap engine of a worker process, created by _init_worker on the first job
+# of the worker
+_worker_swap = None
+
+def _create_swap(swap_method, kwargs):
+    logging.debug(f"Using swapmethod '{swap_method}'")
+
+    if swap_method == "faceswap":
+        from .faceswap import Faceswap
+        return Faceswap(**kwargs)
+    elif swap_method == "faceswap3d":
+        from .faceswap3d import Faceswap3d
+        return Faceswap3d(**kwargs)
+
+# Worker processes don't necessarily share the configuration of the main
+# process (e.g. when they're spawned instead of forked), so pass it along
+WORKER_CONFIG = (
+    "CACHE_LANDMARKS", "DETECTION_CACHE_DIR", "DETECTION_FACE_SIZE",
+    "DETECTION_STRATEGY", "DETECTOR_BACKEND"
+)
+
+def _init_worker(swap_method, kwargs, settings):
+    global _worker_swap
+
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+    preload(kwargs["predictor_path"])
+    _worker_swap = _create_swap(swap_method, kwargs)
+
+# Process pools only have an initializer from Python 3.7, so every job gets
+# the arguments of _init_worker instead, and the worker initializes itself
+# on its first job
+def _worker_call(init_args, fn, *args):
+    if _worker_swap is None:
+        _init_worker(*init_args)
+
+    return fn(_worker_swap, *args)
+
+# These functions do the actual swapping, they only get picklable arguments
+# so they can also run in a worker process. They return a tuple of
+# (result, message, errors) so the messages can be printed by the main
+# process in order
+def _swap_paths(swap, head, face, out, options):
+    msg = f"Faceswapping {face} on {head}, saving to {out}"
+    errors = []
+
+    try:
+        swap.faceswap(
+            head = str(head),
+            face = str(face),
+            output = str(out),
+            order = options["order"],
+            order_repeat = options["order_repeat"]
+        )
+    except TooManyFacesError:
+        errors.append(f"Too many faces, could not swap ({msg})")
+    except NoFacesError:
+        errors.append(f"No faces found, could not swap ({msg})")
+
+        if options["ignore_nofaces"]:
+            errors.append("But ignoring nofaces, so swap anyway")
+            shutil.copy(head, out)
+    except IndexError as e:
+        errors.append(f"Index error: {e}, ({msg})")
+
+    return None, msg, errors
+
+# Like _swap_paths, but with frames in memory instead of paths. The face can
+# also be the path of an image that's used for every frame, so it's only
+# prepared once. The result is the swapped frame, or None if the frame should
+# be skipped
+def _swap_frames(swap, head_im, face, index, options,
+    head_landmarks = None, face_landmarks = None
+):
+    msg = f"Faceswapping frame {index}"
+    errors = []
+    out_im = None
+
+    try:
+        if isinstance(face, str):
+            face = swap.prepare_path(face)
+        else:
+            face = swap.prepare(face, face_landmarks)
+
+        out_im = swap.swap_prepared(
+            swap.prepare(head_im, head_landmarks),
+            face,
+            order = options["order"],
+            order_repeat = options["order_repeat"]
+        )
+    except TooManyFacesError:
+        errors.append(f"Too many faces, could not swap ({msg})")
+    except NoFacesError:
+        errors.append(f"No faces found, could not swap ({msg})")
+
+        if options["ignore_nofaces"]:
+            errors.append("But ignoring nofaces, so swap anyway")
+            out_im = head_im
+    except IndexError as e:
+        errors.append(f"Index error: {e}, ({msg})")
+
+    return out_im, msg, errors
+
+# Decode, swap and encode one (start, length) segment of the head video to
+# out. face is either an image path or a video that's read in lockstep
+def _swap_segment(swap, head, face, segment, out, options):
+    start, length = segment
+    width, height = videosize(head)
+    heads = readframes(head, start, length)
+
+    if is_video(face):
+        faces = readframes(face, start, length)
+    else:
+        faces = repeat(face)
+
+    msg = f"Swapping segment at {start:.2f}s to {out}"
+    errors = []
+
+    try:
+        with FrameWriter(out, width, height, framerate = framerate(head)) as writer:
+            for index, (head_im, face_im) in enumerate(zip(heads, faces)):
+                out_im, _, frame_errors = _swap_frames(
+                    swap, head_im, face_im, index, options
+                )
+                errors.extend(frame_errors)
+
+                if out_im is not None:
+                    writer.write(out_im)
+    finally:
+        heads.close()
+
+        if not isinstance(faces, repeat):
+            faces.close()
+
+    return None, msg, errors
+
 def parse_swap_order(swap_order):
     if swap_order == None:
         return None
@@ -63,7 +212,12 @@ class Swapper:
         concurrent = False,
         ignore_nofaces = False,
         colour_correct = True,
-        temp_dir = None
+        temp_dir = None,
+        stream = False,
+        jobs = 1,
+        track = None,
+        resume = False,
+        segments = None
     ):
         self.done = 0
         self.filecount = None
@@ -82,9 +236,30 @@ class Swapper:
         self.concurrent = concurrent
         self.ignore_nofaces = ignore_nofaces
         self.colour_correct = colour_correct
+        self.track = track
+        self.temp_dir = temp_dir
+        self.resume = resume
+        self.segments = segments
+        self.manifest = None
+
+        # Every segment gets its own worker process, unless the number of
+        # workers is given explicitly
+        if segments and jobs == 1:
+            self.jobs = segments
+        else:
+            self.jobs = jobs
+
+        # Tracking needs all frames in order, so it only works when streaming
+        self.stream = stream or bool(track)
         self.tempdirs = TempDirs(temp_dir)
 
-        kwargs = {
+        if self.segments and track:
+            raise ArgumentError("Tracking is not supported when swapping segments")
+
+        if self.resume and self.stream and not self.segments:
+            raise ArgumentError("Resuming is not supported when streaming")
+
+        self.swap_kwargs = {
             "predictor_path" : self.predictor_path,
             "feather" : self.feather,
             "blur" : self.blur,
@@ -95,73 +270,274 @@ class Swapper:
             "colour_correct" : colour_correct
         }
 
-        logging.debug(f"Using swapmethod '{self.swap_method}'")
+        if self.swap_method == "faceswap3d":
+            self.swap_kwargs["warp_3d"] = self.warp_3d
 
-        if self.swap_method == "faceswap":
-            from .faceswap import Faceswap
-            self.swap = Faceswap(**kwargs)
-        elif self.swap_method == "faceswap3d":
-            from .faceswap3d import Faceswap3d
-            kwargs["warp_3d"] = self.warp_3d
-            self.swap = Faceswap3d(**kwargs)
+        self.swap_options = {
+            "order" : self.swap_order,
+            "order_repeat" : self.swap_order_repeat,
+            "ignore_nofaces" : self.ignore_nofaces
+        }
+
+        # With a process pool every worker loads its own models, so we don't
+        # need them in the main process
+        if self.jobs > 1:
+            logging.debug(f"Using {self.jobs} worker processes")
+            self.swap = None
+        else:
+            self.swap = _create_swap(self.swap_method, self.swap_kwargs)
 
     # FIXME: this swap parameter is *really* confusing, let's fix that at
     # a later time
     def _dirswap(self, image, directory, output_directory, swap = False):
+        self._multiswap(self._dirswaps(image, directory, output_directory, swap))
+
+    def _dirswaps(self, image, directory, output_directory, swap = False):
         logging.debug(f"Directory swapping: {image} to all files in {directory} to {output_directory}")
         mkdir_if_not_exists(output_directory)
         image_base = get_basename(image)
         dirpath = Path(directory)
         self._set_filecount(dirpath.count_images())
 
+        swaps = []
+
         for path in dirpath.images():
             basename = get_basename(path)
             outpath = f"{output_directory}/{image_base}-{basename}.jpg"
 
             if swap:
-                self._faceswap(path, image, outpath)
+                swaps.append([path, image, outpath])
             else:
-                self._faceswap(image, path, outpath)
+                swaps.append([image, path, outpath])
+
+        return swaps
+
+    # Run fn (one of the _swap_ functions) over a list of arguments, in
+    # worker processes, threads or just serially, and yield the results in
+    # order. Only a limited number of items is in flight at the same time
+    # so memory stays flat, even with long videos
+    def _map(self, fn, arguments):
+        if self.jobs > 1:
+            max_workers = self.jobs
+            executor = ProcessPoolExecutor(max_workers = max_workers)
+            init_args = (
+                self.swap_method,
+                self.swap_kwargs,
+                { key : getattr(config, key) for key in WORKER_CONFIG }
+            )
+            submit = lambda args: executor.submit(_worker_call, init_args, fn, *args)
+        elif self.concurrent:
+            max_workers = THREAD_WORKERS
+            executor = ThreadPoolExecutor(max_workers = max_workers)
+            submit = lambda args: executor.submit(fn, self.swap, *args)
+        else:
+            for args in arguments:
+                yield self._report(*fn(self.swap, *args))
 
-    def _faceswap(self, head, face, out):
-        msg = f"Faceswapping {face} on {head}, saving to {out}"
-        self.last_message = msg
+            self._log_cache()
+            return
 
-        try:
-            self.swap.faceswap(
-                head = str(head),
-                face = str(face),
-                output = str(out),
-                order = self.swap_order,
-                order_repeat = self.swap_order_repeat
-            )
-        except TooManyFacesError:
-            message(f"Too many faces, could not swap ({msg})")
-        except NoFacesError:
-            message(f"No faces found, could not swap ({msg})")
+        pending = deque()
+
+        with executor:
+            for args in arguments:
+                pending.append(submit(args))
+
+                if len(pending) >= max_workers * 2:
+                    yield self._report(*pending.popleft().result())
+
+            while pending:
+                yield self._report(*pending.popleft().result())
+
+        self._log_cache()
+
+    # Worker processes have their own caches, so we can only log this when
+    # swapping in the main process
+    def _log_cache(self):
+        if self.swap:
+            logging.debug(f"Landmark cache: {self.swap.landmark_cache}")
+
+    # Swaps are lists of [head, face, ..., out]
+    def _swap_key(self, head, face, *rest):
+        return manifest_key(
+            file_key(head), file_key(face), *rest, self.swap_method,
+            self.swap_kwargs, self.swap_options
+        )
+
+    def _multiswap(self, swaps, fn = _swap_paths):
+        if self.manifest:
+            swaps = self._unfinished(swaps)
+
+        arguments = ((*swap, self.swap_options) for swap in swaps)
+        results = self._map(fn, arguments)
+
+        # Results come in the same order as the swaps
+        for _, swap in zip(results, swaps):
+            if self.manifest:
+                self.manifest.add(self._swap_key(*swap), swap[-1])
+
+    # Skip swaps that were finished in an earlier run, but still report
+    # them so the progress bar is correct
+    def _unfinished(self, swaps):
+        unfinished = []
+
+        for swap in swaps:
+            if self.manifest.is_done(self._swap_key(*swap)):
+                self._report(None, f"Already swapped {swap[-1]}", [])
+            else:
+                unfinished.append(swap)
+
+        logging.debug(f"Resuming, {len(unfinished)} of {len(swaps)} swaps left")
+        return unfinished
+
+    # When resuming, use temporary directories and a manifest that only
+    # depend on the output, so running the same command again finds them
+    def _start(self, out):
+        if not self.resume:
+            return
+
+        suffix = manifest_key(os.path.abspath(out))[:8]
+        self.tempdirs = TempDirs(self.temp_dir, suffix)
+        path = f"{self.tempdirs.prefix}resume-{suffix}.jsonl"
+        logging.debug(f"Keeping track of finished swaps in {path}")
+        self.manifest = Manifest(path)
+
+    # Everything is done, so there is nothing to resume anymore
+    def _finish(self):
+        if self.manifest:
+            self.manifest.remove()
+            self.manifest = None
+
+    def _mkdirs(self, paths):
+        for path in paths:
+            if self.resume:
+                mkdir_if_not_exists(path)
+            else:
+                force_mkdir(path)
+
+    # Extract frames or audio from inp to the directory out, unless that
+    # was already finished in an earlier run
+    def _extract(self, fn, inp, out):
+        key = manifest_key(fn.__name__, file_key(inp), out)
+
+        if self.manifest and self.manifest.is_done(key):
+            logging.debug(f"Skipping {fn.__name__} of {inp}, already done")
+            return
+
+        # Throw away anything an interrupted run left behind
+        force_mkdir(out)
+        fn(inp, out)
+
+        if self.manifest:
+            self.manifest.add(key)
+
+    # Swap all frames of a video to the out temporary directory and number
+    # them for combining. Numbering renames the frames, so after that the
+    # swaps can't be checked anymore and we record the whole directory
+    def _swap_video_frames(self, swaps):
+        key = manifest_key("frames", self.tempdirs.out)
+
+        if self.manifest and self.manifest.is_done(key):
+            logging.debug("Skipping swapping frames, already done")
+            return
+
+        self._multiswap(swaps)
+        numberize_files(self.tempdirs.out)
 
-            if self.ignore_nofaces:
-                message("But ignoring nofaces, so swap anyway")
-                shutil.copy(head, out)
-        except IndexError as e:
-            message(f"Index error: {e}, ({msg})")
+        if self.manifest:
+            self.manifest.add(key)
 
+    def _report(self, result, msg, errors):
+        self.last_message = msg
+        [message(error) for error in errors]
         self.done = self.done + 1
 
         if self.reporthook:
             self.reporthook()
 
-    # This is a wrapper so we can control multithreading
-    def _multiswap(self, swaps):
-        if self.concurrent:
-            paths, faces, outpaths = zip(*swaps)
+        return result
+
+    def _get_tracker(self):
+        from .tracker import LandmarkTracker
+
+        return LandmarkTracker(
+            predictor_path = self.predictor_path,
+            interval = self.track,
+            upsample = 0 if self.swap_method == "faceswap3d" else 1
+        )
+
+    # Swap (head, face) frame pairs and yield the results in order. When
+    # tracking, landmarks are calculated here, in order, so the workers
+    # only need to do the blending
+    def _streamswap(self, frames, track_faces = False):
+        if not self.track:
+            arguments = (
+                (head_im, face_im, index, self.swap_options)
+                for index, (head_im, face_im) in enumerate(frames)
+            )
+
+            return self._map(_swap_frames, arguments)
+
+        head_tracker = self._get_tracker()
+        face_tracker = self._get_tracker() if track_faces else None
+
+        def tracked():
+            for index, (head_im, face_im) in enumerate(frames):
+                head_landmarks = head_tracker.landmarks(head_im)
+
+                if face_tracker:
+                    face_landmarks = face_tracker.landmarks(face_im)
+                else:
+                    face_landmarks = None
+
+                yield (head_im, face_im, index, self.swap_options,
+                       head_landmarks, face_landmarks)
+
+            logging.debug(f"Did {head_tracker.detections} full face detections")
+
+        return self._map(_swap_frames, tracked())
+
+    def _streamswap_to_video(self, head, frames, out, audio = None, track_faces = False):
+        width, height = videosize(head)
+        fps = framerate(head)
+        logging.debug(f"Streaming {width}x{height}@{fps} frames to {out}")
+
+        with FrameWriter(out, width, height, framerate = fps, audio = audio) as writer:
+            for out_im in self._streamswap(frames, track_faces):
+                if out_im is not None:
+                    writer.write(out_im)
+
+    # Split the head video at keyframes and let every worker decode, swap
+    # and encode its own segment, then join the segments without encoding
+    # them again
+    def _segmentswap(self, head, face, out, audio = None):
+        self._start(out)
+        self._mkdirs([self.tempdirs.out])
+        segments = keyframe_segments(head, self.segments)
+        self._set_filecount(len(segments))
+        logging.debug(f"Swapping {len(segments)} segments of {head}")
+
+        swaps = []
+
+        for index, segment in enumerate(segments):
+            outpath = f"{self.tempdirs.out}/{str(index).zfill(4)}.mp4"
+            swaps.append([head, face, segment, outpath])
+
+        self._multiswap(swaps, _swap_segment)
+        concatvideos([swap[-1] for swap in swaps], out, audio)
+
+        if not self.keep_temp:
+            shutil.rmtree(self.tempdirs.out)
 
-            with ThreadPoolExecutor(max_workers = 20) as executor:
-                executor.map(self._faceswap, paths, faces, outpaths)
+        self._finish()
+
+    def _video_audio(self, face):
+        if not self.swap_audio:
+            return None
+        elif self.audio_input:
+            return self.audio_input
         else:
-            # Simply iterate over the list instead of using the
-            # threaded model
-            [self._faceswap(*swap) for swap in swaps]
+            return face
 
     def _set_filecount(self, filecount):
         if not self.filecount:
@@ -172,25 +548,57 @@ class Swapper:
     def swap_directory_to_directory(self, face_dir, head_dir, out_dir):
         logging.debug(f"Dir to dir: faces in {face_dir} to heads in {head_dir} to {out_dir}")
         self._set_filecount(Path(face_dir).count_images() * Path(head_dir).count_images())
+        self._start(out_dir)
+
+        # Do all swaps in one go, so every worker only needs to prepare
+        # every face and head once
+        swaps = []
 
         for face in Path(face_dir).images():
-            self.swap_image_to_directory(str(face), head_dir, out_dir)
+            logging.debug(f"Image to dir: face of {face} to {head_dir}")
+            swaps.extend(self._dirswaps(str(face), head_dir, out_dir, swap = True))
+
+        self._multiswap(swaps)
+        self._finish()
 
     def swap_directory_to_image(self, directory, image, out):
         logging.debug(f"Dir to image: faces of {directory} to {image}")
+        self._start(out)
         self._dirswap(image, directory, out)
+        self._finish()
 
     def swap_image_to_directory(self, image, directory, out):
         logging.debug(f"Image to dir: face of {image} to {directory}")
+        self._start(out)
         self._dirswap(image, directory, out, swap = True)
+        self._finish()
 
     def swap_image_to_image(self, head, face, out):
         self.filecount = 1
-        self._faceswap(head, face, out)
+        self._start(out)
+        self._multiswap([[head, face, out]])
+        self._finish()
 
     def swap_image_to_video(self, head, face, out):
-        [force_mkdir(p) for p in self.tempdirs.img_to_video]
-        extractframes(head, self.tempdirs.head)
+        if self.segments:
+            self._segmentswap(head, face, out)
+            return
+
+        if self.stream:
+            self._set_filecount(framecount(head))
+            heads = readframes(head)
+
+            try:
+                frames = ((head_im, str(face)) for head_im in heads)
+                self._streamswap_to_video(head, frames, out)
+            finally:
+                heads.close()
+
+            return
+
+        self._start(out)
+        self._mkdirs(self.tempdirs.img_to_video)
+        self._extract(extractframes, head, self.tempdirs.head)
         dirpath = Path(self.tempdirs.head)
         self._set_filecount(dirpath.count_images())
 
@@ -200,19 +608,42 @@ class Swapper:
             outpath = f"{self.tempdirs.out}/{get_basename(path)}.jpg"
             swaps.append([path, face, outpath])
 
-        self._multiswap(swaps)
-
-        numberize_files(self.tempdirs.out)
+        self._swap_video_frames(swaps)
         combineframes(self.tempdirs.out, out)
 
         if not self.keep_temp:
             [shutil.rmtree(p) for p in self.tempdirs.img_to_video]
 
+        self._finish()
+
     def swap_video_to_video(self, head, face, out):
-        [force_mkdir(p) for p in self.tempdirs.video_to_video]
-        extractframes(head, self.tempdirs.head)
-        extractframes(face, self.tempdirs.face)
-        extractaudio(face, self.tempdirs.audio)
+        if self.segments:
+            self._segmentswap(head, face, out, self._video_audio(face))
+            return
+
+        if self.stream:
+            self._set_filecount(framecount(head))
+            audio = self._video_audio(face)
+            heads = readframes(head)
+            faces = readframes(face)
+
+            # Read both videos in lockstep, zip stops at the shortest
+            # one, just like the non-streaming version
+            try:
+                self._streamswap_to_video(
+                    head, zip(heads, faces), out, audio, track_faces = True
+                )
+            finally:
+                heads.close()
+                faces.close()
+
+            return
+
+        self._start(out)
+        self._mkdirs(self.tempdirs.video_to_video)
+        self._extract(extractframes, head, self.tempdirs.head)
+        self._extract(extractframes, face, self.tempdirs.face)
+        self._extract(extractaudio, face, self.tempdirs.audio)
 
         heads = sorted(glob(f"{self.tempdirs.head}/*"))
         faces = sorted(glob(f"{self.tempdirs.face}/*"))
@@ -235,9 +666,7 @@ class Swapper:
             face = faces[index]
             swaps.append([path, face, outpath])
 
-        self._multiswap(swaps)
-
-        numberize_files(self.tempdirs.out)
+        self._swap_video_frames(swaps)
 
         if not self.swap_audio:
             combineframes(self.tempdirs.out, out)
@@ -254,4 +683,6 @@ class Swapper:
             combineaudio(TMP_VIDEO, audio_file, out)
 
         if not self.keep_temp:
-            [shutil.rmtree(p) for p in self.tempdirs.video_to_video]
\ No newline at end of file
+            [shutil.rmtree(p) for p in self.tempdirs.video_to_video]
+
+        self._finish()
\ No newline at end of file
@@ -0,0 +1,86 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from .agegender import OUTPUT_NAMES, postprocess, preprocess
+from .profiler import Profiler
+from . import resnet
+profiler = Profiler("tfmodel.py")
+
+import tensorflow as tf
+
+# Builds the age and gender network for preprocessed (see
+# agegender.preprocess) 160x160 RGB images, in inference mode
+def _build_graph():
+    images_pl = tf.placeholder(tf.float32, shape=[None, 160, 160, 3], name='input_image')
+    age_logits, gender_logits, _ = resnet.inference(images_pl, keep_probability=0.8,
+                                                    phase_train=False,
+                                                    weight_decay=1e-5)
+    age = tf.nn.softmax(age_logits, name=OUTPUT_NAMES[0])
+    gender = tf.nn.softmax(gender_logits, name=OUTPUT_NAMES[1])
+    return images_pl, age, gender
+
+def _restore(session, model_path):
+    init_op = tf.group(
+        tf.global_variables_initializer(),
+        tf.local_variables_initializer()
+    )
+
+    session.run(init_op)
+    saver = tf.train.Saver()
+    ckpt = tf.train.get_checkpoint_state(model_path)
+
+    if ckpt and ckpt.model_checkpoint_path:
+        saver.restore(session, ckpt.model_checkpoint_path)
+        logger.debug("Session restorted")
+    else:
+        raise IOError(f"Could not find a checkpoint in {model_path}")
+
+"""
+The age and gender network with its TensorFlow session. Restoring the
+checkpoint is slow, so this is created once per process through the model
+registry and shared by all Classify instances. Only used when the model
+hasn't been exported with export_model.
+"""
+class TfAgeGenderModel:
+    def __init__(self, model_path):
+        logger.debug("Creating session")
+
+        with tf.Graph().as_default():
+            self.session = tf.Session()
+            self._images_pl, self._age, self._gender = _build_graph()
+            _restore(self.session, model_path)
+
+        profiler.tick("Created session")
+
+    def evaluate(self, aligned_images):
+        ages, genders = self.session.run(
+            [self._age, self._gender],
+
+            feed_dict = {
+                self._images_pl: preprocess(aligned_images)
+            }
+        )
+
+        return postprocess(ages, genders)
+
+"""
+Freezes the checkpoint in model_path into a single graph file with the
+weights as constants, that can be run by OpenCV's dnn module without
+TensorFlow. Preprocessing isn't part of the graph, that's done in numpy.
+"""
+def export_model(model_path, out_path):
+    with tf.Graph().as_default() as graph:
+        with tf.Session() as session:
+            _build_graph()
+            _restore(session, model_path)
+
+            frozen = tf.graph_util.convert_variables_to_constants(
+                session, graph.as_graph_def(), OUTPUT_NAMES
+            )
+
+    frozen = tf.graph_util.remove_training_nodes(frozen)
+
+    with open(out_path, "wb") as f:
+        f.write(frozen.SerializeToString())
+
+    logger.debug(f"Exported {len(frozen.node)} nodes to {out_path}")
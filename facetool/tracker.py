@@ -0,0 +1,108 @@
+import dlib
+import logging
+import numpy as np
+from .constants import DEFAULT_TRACK_INTERVAL, MIN_TRACK_OVERLAP
+from .detector import FaceDetector
+from .models import get_predictor
+
+logger = logging.getLogger(__name__)
+
+# Intersection over union of two (left, top, right, bottom) boxes
+def _overlap(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+
+    if w <= 0 or h <= 0:
+        return 0.0
+
+    intersection = w * h
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+
+    return intersection / (area_a + area_b - intersection)
+
+# The shape predictor is trained on detector boxes, not on the bounding box
+# of the landmarks, so we remember where the detector box was relative to
+# the centroid and spread of the landmarks and use that to place the box on
+# the next frame
+def _relative_box(rect, points):
+    centroid = points.mean(axis = 0)
+    spread = points.std()
+
+    return np.array([
+        (rect.left() - centroid[0]) / spread,
+        (rect.top() - centroid[1]) / spread,
+        (rect.right() - centroid[0]) / spread,
+        (rect.bottom() - centroid[1]) / spread
+    ])
+
+def _absolute_box(points, relbox):
+    centroid = points.mean(axis = 0)
+    spread = points.std()
+    return np.tile(centroid, 2) + relbox * spread
+
+"""
+Gets landmarks for consecutive frames of a video. A full face detection is
+only done every `interval` frames, in between the shape predictor is seeded
+with a box propagated from the landmarks of the previous frame. When the
+landmarks drift too far from that box (e.g. because of a cut or fast
+movement) we fall back to a full detection. Frames need to be given in
+order, so use one tracker per video.
+"""
+class LandmarkTracker:
+    def __init__(self, predictor_path,
+        interval = DEFAULT_TRACK_INTERVAL,
+        upsample = 1,
+        min_overlap = MIN_TRACK_OVERLAP
+    ):
+        self.detector = FaceDetector()
+        self.predictor = get_predictor(predictor_path)
+        self.interval = interval
+        self.upsample = upsample
+        self.min_overlap = min_overlap
+        self.detections = 0
+        self.frames = 0
+
+        # List of (landmarks, relative box) tuples of the last frame
+        self.faces = []
+
+    def _detect(self, im):
+        rects = self.detector(im, self.upsample)
+        self.detections = self.detections + 1
+        self.faces = []
+
+        for rect in rects:
+            points = self._shape(im, rect)
+            self.faces.append((points, _relative_box(rect, points)))
+
+        self.frames = 0
+
+    def _shape(self, im, rect):
+        shape = self.predictor(im, rect)
+        return np.array([[p.x, p.y] for p in shape.parts()], dtype = np.int32)
+
+    def _track(self, im):
+        faces = []
+
+        for points, relbox in self.faces:
+            seed = _absolute_box(points, relbox)
+            rect = dlib.rectangle(*[int(round(v)) for v in seed])
+            new_points = self._shape(im, rect)
+
+            if _overlap(seed, _absolute_box(new_points, relbox)) < self.min_overlap:
+                logger.debug("Lost track of face, detecting again")
+                return False
+
+            faces.append((new_points, relbox))
+
+        self.faces = faces
+        return True
+
+    # Returns a list with a (68, 2) array of landmarks for every face
+    def landmarks(self, im):
+        self.frames = self.frames + 1
+
+        if not self.faces or self.frames >= self.interval or not self._track(im):
+            self._detect(im)
+
+        return [points for points, relbox in self.faces]
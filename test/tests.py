@@ -15,6 +15,22 @@ TESTS = [
         "label" : "Crop faces (directory)",
         "command" : "crop -i test/img-single -o test/output/crop-folder"
     },
+    {
+        "label" : "Count faces (detection cache)",
+        "command" : "count -i test/img-group/1.jpg --cache-dir test/output/cache"
+    },
+    {
+        "label" : "Count faces (adaptive detection)",
+        "command" : "count -i test/img-group/1.jpg --detection-strategy adaptive"
+    },
+    {
+        "label" : "Count faces (Haar cascade)",
+        "command" : "count -i test/img-group/1.jpg --detector haar"
+    },
+    {
+        "label" : "Locate faces (tiled)",
+        "command" : "locate -i test/img-group/1.jpg -o test/output/locate-tiled.jpg --tile-size 256 -j 2"
+    },
     {
         "label" : "Locate faces (image)",
         "command" : "locate -i test/img-single/1.jpg"
@@ -23,10 +39,54 @@ TESTS = [
         "label" : "Face distance (image to dir)",
         "command" : "distance -t test/img-recognize/obama -i test/img-recognize/trump/trump.jpg"
     },
+    {
+        "label" : "Landmarks (npy store)",
+        "command" : "landmarks -i test/img-single -of npy -o test/output/landmarks"
+    },
+    {
+        "label" : "Encode faces (binary)",
+        "command" : "encode -i test/img-recognize/obama -o test/output/encodings.npy"
+    },
+    {
+        "label" : "Encode faces (incremental)",
+        "command" : "encode -i test/img-recognize/obama -o test/output/encodings.npy --incremental"
+    },
+    {
+        "label" : "Face distance (binary encodings)",
+        "command" : "distance -i test/img-recognize/trump/trump.jpg -m test/output/encodings.npy"
+    },
+    {
+        "label" : "Face distance (many to many)",
+        "command" : "distance -i test/img-recognize/trump -m test/output/encodings.npy --top-k 2"
+    },
+    {
+        "label" : "Face distance (many to many, CSV)",
+        "command" : "distance -i test/output/encodings.npy -m test/output/encodings.npy --max-distance 0.6 -of csv -o test/output/matches.csv"
+    },
+    {
+        "label" : "Quantize encodings",
+        "command" : "quantize -i test/output/encodings.npy --quantization pq"
+    },
+    {
+        "label" : "Face distance (quantized)",
+        "command" : "distance -i test/img-recognize/trump/trump.jpg -m test/output/encodings.npy --top-k 3"
+    },
+    {
+        "label" : "Index encodings",
+        "command" : "index -i test/output/encodings.npy"
+    },
+    {
+        "label" : "Face distance (index)",
+        "command" : "distance -i test/img-recognize/trump/trump.jpg -m test/output/encodings.npy --top-k 3"
+    },
     {
         "label" : "Pose face (image)",
         "command" : "pose -i test/img-single/1.jpg -o test/output/pose-image.jpg"
     },
+    {
+        "label" : "Pose face (detection cache)",
+        "command" : "pose -i test/img-single/1.jpg -o test/output/pose-image-cache.jpg --cache-dir test/output/cache"
+    },
     {
         "label" : "Probe image",
         "command" : "probe -i test/img-single/1.jpg"
@@ -67,6 +127,34 @@ TESTS = [
         "label" : "Swap video to video",
         "command" : "swap -i test/video/1.mp4 -t test/video/2.mp4 -o test/output/swap-video-to-video.mp4"
     },
+    {
+        "label" : "Swap image to video (worker processes)",
+        "command" : "swap -i test/img-single/1.jpg -t test/video/1.mp4 -o test/output/swap-image-to-video-jobs.mp4 -j 4"
+    },
+    {
+        "label" : "Swap image to video (streaming)",
+        "command" : "swap -i test/img-single/1.jpg -t test/video/1.mp4 -o test/output/swap-image-to-video-stream.mp4 --stream"
+    },
+    {
+        "label" : "Swap video to video (streaming)",
+        "command" : "swap -i test/video/1.mp4 -t test/video/2.mp4 -o test/output/swap-video-to-video-stream.mp4 --stream"
+    },
+    {
+        "label" : "Swap video to video (tracking)",
+        "command" : "swap -i test/video/1.mp4 -t test/video/2.mp4 -o test/output/swap-video-to-video-track.mp4 --track 10"
+    },
+    {
+        "label" : "Swap image to video (resumable)",
+        "command" : "swap -i test/img-single/1.jpg -t test/video/1.mp4 -o test/output/swap-image-to-video-resume.mp4 --resume"
+    },
+    {
+        "label" : "Swap video to video (segments)",
+        "command" : "swap -i test/video/1.mp4 -t test/video/2.mp4 -o test/output/swap-video-to-video-segments.mp4 --segments 4"
+    },
+    {
+        "label" : "Export classify model",
+        "command" : "exportmodel -i data -o test/output/agegender.pb"
+    },
     {
         "label" : "Classify faces",
         "command" : "classify -i test/img-single -of csv -o test/output/classify.csv"